@@ -2,9 +2,15 @@ import logging
 from rich.logging import RichHandler
 from rich.console import Console
 
-from protorpc.api import Api, FrameDict, parse_fields
+from protorpc.api import Api, CancelToken, FrameDict, parse_fields, make_api
+from protorpc.recorder import Recorder
+from protorpc.poller import Poller
+from protorpc.stream import StreamChannel
+from protorpc.pool import ConnectionPool
 from protorpc.connection.udp_connection import UdpConnection
 from protorpc.connection.tcp_connection import TcpConnection
+from protorpc.connection.udp_fanout import FanoutConnection
+from protorpc.connection.loopback import LoopbackServer, LoopbackConnection
 
 
 logger = logging.getLogger(__name__)
@@ -50,20 +56,48 @@ def setup_logging(rootlogger, level, logfile=None):
 def build_api(frame_cls, **kwargs):
     """Builds the RPC api from the frame class.
     Accepts the following kwargs:
-    protocol : ['tcp', 'udp']
+    protocol : ['tcp', 'udp', 'fanout', 'serial', 'loopback']
+               serial: needs pyserial, see serial_port and baudrate
+               loopback: in-process, server is a LoopbackServer
+               fanout: addr is a broadcast or multicast group address, calls
+               are made with call.fanout(..., timeout, expected)
     port     : some integer
     addr     : server IP address (optional).
     hostname : server hostname (optional)
+    compress : enable payload compression, both ends must support it (optional)
+    max_frame_len: largest frame accepted on TCP and serial links, in COBS
+               encoded bytes (default 1 MB).  A request whose reply is
+               larger fails with "REPLY TOO LARGE".
+    profile  : socket profile ['default', 'low_latency', 'bulk'] (optional)
+    keepalive: enable TCP keepalive, True or a sockopts.Keepalive (optional)
+    reconnect: reconnect automatically when a TCP link is lost (default True)
+    writer   : send through a writer thread with a bounded queue (optional)
+               see also writer_queue, writer_batch and
+               backpressure ['block', 'fail', 'drop_oldest']
+    heartbeat: ping the device after this many idle seconds (optional)
+    pack     : COBS frame every UDP datagram, packing several frames per
+               datagram up to mtu bytes (optional)
+    reliable : retransmit unanswered idempotent UDP requests (optional), see also
+               max_retries and ack_no_reply
+    fragment : send UDP frames larger than mtu as fragments (optional)
     """
     protocol = kwargs.pop('protocol', 'tcp')
 
-    supported_prots = ['tcp', 'udp']
+    supported_prots = ['tcp', 'udp', 'fanout', 'serial', 'loopback']
 
     if protocol not in supported_prots:
         raise ProtoRpcException(f"Unsupported protocol: {protocol}. "
                                 f"Must be {supported_prots}.")
 
-    connectCls = {'tcp': TcpConnection, 'udp': UdpConnection}[protocol]
+    if protocol == 'serial':
+        # Optional dependency (pyserial).
+        from protorpc.connection.serial_connection import SerialConnection
+        connectCls = SerialConnection
+    else:
+        connectCls = {'tcp': TcpConnection,
+                      'udp': UdpConnection,
+                      'fanout': FanoutConnection,
+                      'loopback': LoopbackConnection}[protocol]
     logger.debug(f"Using connection class={connectCls.__name__}")
     try:
         conn = connectCls(**kwargs)
@@ -72,12 +106,4 @@ def build_api(frame_cls, **kwargs):
         logger.error(f"build_api: Connection error ({protocol}).")
         raise ProtoRpcException(e)
 
-    api = {}
-    parse_fields(frame_cls())
-    logger.debug(f"FrameDict={FrameDict}")
-
-    for callset in FrameDict:
-        logger.debug(f"Building api for callset: '{callset}'")
-        api[callset] = Api(frame_cls, FrameDict[callset], conn)
-
-    return api, conn
+    return make_api(frame_cls, conn), conn
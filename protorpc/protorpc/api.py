@@ -1,15 +1,21 @@
 import sys
-import time
+import asyncio
 import datetime
 import logging
 import typing as t
 
+from threading import Event, Lock
 from dataclasses import dataclass, fields
 from rich import inspect
 
+import betterproto
+
+from protorpc.stream import StreamChannel
+
 logger = logging.getLogger(__name__)
 
 FrameDict = {}
+HeaderFields = {}
 
 
 @dataclass
@@ -80,10 +86,75 @@ def parse_fields(frame, callset_inst=None, msg_inst=None, debug=False):
         msg_inst.args.append(MsgArg(**kwargs))
 
 
+def get_header_field(frame_cls):
+    """Gets the (field number, header class) of a frame class header field.
+    """
+    if frame_cls not in HeaderFields:
+        frame = frame_cls()
+        for field in fields(frame):
+            if field.name == 'header':
+                number = get_field_metadata(field).get('number')
+                HeaderFields[frame_cls] = (number, frame._cls_for(field))
+                break
+        else:
+            raise AttributeError(f"{frame_cls.__name__} has no header field.")
+
+    return HeaderFields[frame_cls]
+
+
+def parse_header(frame_cls, data):
+    """Decodes only the header of a serialized frame, skipping the (possibly
+    large) callset body.
+    """
+    number, header_cls = get_header_field(frame_cls)
+    for parsed in betterproto.parse_fields(data):
+        if parsed.number == number:
+            return header_cls().parse(parsed.value)
+    return header_cls()
+
+
+class CancelToken:
+    """Cancellation token which can be shared between requests.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.requests = set()
+        self.lock = Lock()
+
+    def register(self, request):
+        """Registers a request to be cancelled with the token.
+        """
+        with self.lock:
+            if not self.cancelled:
+                self.requests.add(request)
+                return
+        request.cancel()
+
+    def unregister(self, request):
+        """Removes a finished request from the token.
+        """
+        with self.lock:
+            self.requests.discard(request)
+
+    def cancel(self):
+        """Cancels all requests registered with the token.
+        """
+        with self.lock:
+            self.cancelled = True
+            requests, self.requests = self.requests, set()
+
+        for request in requests:
+            request.cancel()
+
+
 class Request:
     """RPC request class.
     """
 
+    # Connections with a reliability layer may retransmit the request.
+    retransmit = True
+
     def __init__(
         self,
         frame_cls,
@@ -95,13 +166,27 @@ class Request:
         **kwargs
     ):
         self.no_reply = kwargs.pop('no_reply', False)
+        # Optional absolute deadline (datetime) and cancellation token.
+        self.deadline = kwargs.pop('deadline', None)
+        self.cancel_token = kwargs.pop('cancel_token', None)
+        # Idempotent requests are replayed if the connection is re-established.
+        self.idempotent = kwargs.pop('idempotent', False)
+        self.ser = None
+        self.codec_stats = None
         self.conn = conn
         self.frame = frame_cls()
-        self.callset = callset_inst
+        # Own callset instance, so requests built before being sent (batches,
+        # polling) do not share the msg set on the Api callset instance.
+        self.callset = type(callset_inst)()
         self.header = self.frame.header
         self.reply = Reply(frame_cls, msg_name, msg_inst)
         self.got_reply = False
         self.timedout = False
+        self.cancelled = False
+        self.failed = False
+        self.done_event = Event()
+        self.done_callbacks = []
+        self.lock = Lock()
 
         self.msg_name = msg_name
         self.msg_inst = msg_inst
@@ -110,34 +195,168 @@ class Request:
         setattr(self.callset, msg_name, msg_inst)
         setattr(self.frame, callset_name, self.callset)
 
-    def send(self, timeout=3):
-        """Sends a serialized RPC frame using the underlying connection object.
+    def prepare(self, timeout=3):
+        """Assigns the seqn and ttl and registers the request as pending.
+        Returns the serialized frame, or None if the request was cancelled or
+        is past its deadline.
         """
         self.header.seqn = self.conn.get_next_seqn()
-        self.header.no_reply = self.no_reply
+        # An acknowledged no_reply request asks for a reply, but callers
+        # still do not wait for it.
+        acked = self.no_reply and self.conn.ack_no_reply
+        self.header.no_reply = self.no_reply and not acked
         ser = self.frame.SerializeToString()
+        self.ser = ser
         self.ttl = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+        if self.deadline is not None:
+            self.ttl = min(self.ttl, self.deadline)
+
+        if self.cancel_token is not None:
+            self.cancel_token.register(self)
+        if self.cancelled:
+            logger.debug(f"Request seqn={self.seqn} cancelled before send.")
+            return None
+        if datetime.datetime.now() > self.ttl:
+            logger.debug(f"Request seqn={self.seqn} past deadline before send.")
+            self.set_timedout()
+            return None
+
         logger.debug(f"sending request: {self.frame}")
-        self.conn.write(ser)
 
-        if self.no_reply:
-            return
-        else:
+        # Register before writing so a fast reply is never missed.
+        if not self.header.no_reply:
             self.conn.add_pending(self)
+        return ser
+
+    def send(self, timeout=3):
+        """Sends a serialized RPC frame using the underlying connection object.
+        """
+        ser = self.prepare(timeout)
+        if ser is None:
+            return
+
+        try:
+            if self.conn.writer is not None:
+                # Queued; codec stats are set once written.
+                self.conn.writer.submit(ser, self)
+            else:
+                self.codec_stats = self.conn.write(ser)
+        except ConnectionError:
+            # Idempotent requests stay pending while the link is re-established
+            # and are replayed once it is back.
+            if not (self.idempotent and self.conn.queue_replay(self)):
+                self.conn.remove_pending(self.seqn)
+                raise
+            logger.debug(f"Request seqn={self.seqn} queued for replay.")
+        except Exception:
+            self.conn.remove_pending(self.seqn)
+            raise
 
     def send_sync(self, timeout=3):
-        """Sends and waits for success or timeout.
+        """Sends and waits for success, timeout or cancellation.
         """
         self.send(timeout)
 
         if not self.no_reply:
-            while True:
-                time.sleep(0.1)
-                if self.timedout:
-                    self.reply.set_timedout()
-                    return
-                if self.got_reply:
-                    return
+            while not self.done_event.wait(0.1):
+                # Fallback in case the connection is no longer servicing
+                # pending requests.
+                if datetime.datetime.now() > self.ttl + datetime.timedelta(seconds=1):
+                    self.conn.remove_pending(self.seqn)
+                    self.set_timedout()
+
+    async def send_async(self, timeout=3):
+        """Sends and awaits the reply.  Cancelling the awaiting task cancels
+        the request.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def on_done(request):
+            def set_result():
+                if not future.done():
+                    future.set_result(request.reply)
+            try:
+                loop.call_soon_threadsafe(set_result)
+            except RuntimeError:
+                # Event loop already closed.
+                pass
+
+        self.add_done_callback(on_done)
+        self.send(timeout)
+
+        if self.no_reply:
+            return self.reply
+
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+    def add_done_callback(self, func):
+        """Adds a function called with the request once it is done.  Called
+        immediately if the request is already done.
+        """
+        with self.lock:
+            if not self.done:
+                self.done_callbacks.append(func)
+                return
+        func(self)
+
+    def _finish(self, state):
+        """Sets the final request state (only the first one wins) and notifies
+        waiters.
+        """
+        with self.lock:
+            if self.done:
+                return False
+            setattr(self, state, True)
+            callbacks, self.done_callbacks = self.done_callbacks, []
+
+        self.done_event.set()
+        if self.cancel_token is not None:
+            self.cancel_token.unregister(self)
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception as e:
+                logger.exception(f"Request done callback: {str(e)}")
+        return True
+
+    def handle_reply(self, data):
+        """Called by the connection with the raw reply frame for this request.
+        """
+        self.reply.rcv_handler(data)
+        self._finish('got_reply')
+
+    def set_timedout(self):
+        self.reply.set_timedout()
+        self._finish('timedout')
+
+    def set_failed(self, reason="CONNECTION LOST"):
+        """Fails the request (connection lost, send queue overflow).
+        """
+        self.reply.set_failed(reason)
+        self._finish('failed')
+
+    def cancel(self):
+        """Cancels the request.  It is removed from the connection pending list
+        immediately and a late reply is dropped.
+        """
+        if self.done:
+            return
+        self.conn.remove_pending(self.seqn)
+        self.reply.set_cancelled()
+        if self._finish('cancelled'):
+            logger.debug(f"Request seqn={self.seqn} cancelled.")
+
+    @property
+    def done(self):
+        """True once the request has a reply, has timed out, failed or is
+        cancelled.
+        """
+        return self.got_reply or self.timedout or self.cancelled or self.failed
 
     @property
     def seqn(self):
@@ -146,6 +365,30 @@ class Request:
         return self.header.seqn
 
 
+def send_batch(requests, timeout=3):
+    """Sends several requests sharing a connection with a single write.
+    """
+    if not requests:
+        return
+
+    conn = requests[0].conn
+    batch = [(req, req.prepare(timeout)) for req in requests]
+    batch = [(req, ser) for req, ser in batch if ser is not None]
+
+    try:
+        if conn.writer is not None:
+            conn.writer.submit_many([(ser, req) for req, ser in batch])
+            return
+        samples = conn.write_many([ser for _, ser in batch])
+    except Exception:
+        for req, _ in batch:
+            conn.remove_pending(req.seqn)
+        raise
+
+    for (req, _), sample in zip(batch, samples):
+        req.codec_stats = sample
+
+
 class Reply:
     """RPC reply class.
     """
@@ -158,6 +401,10 @@ class Reply:
         self.result = None
         self.success = False
         self.timedout = False
+        self.cancelled = False
+        self.failed = False
+        self.fail_reason = None
+        self.codec_stats = None
 
     def rcv_handler(self, data):
         """Parses raw received frame into class instance.
@@ -187,10 +434,17 @@ class Reply:
     def set_timedout(self):
         self.timedout = True
 
+    def set_cancelled(self):
+        self.cancelled = True
+
+    def set_failed(self, reason="CONNECTION LOST"):
+        self.failed = True
+        self.fail_reason = reason
+
     def exit_on_fail(self, on_exit_func=None):
         """Checks the return code and exits on failure.
         """
-        if self.timedout or not self.success:
+        if self.timedout or self.cancelled or self.failed or not self.success:
             logger.error(f"RPC error: {self.status_str}")
             if on_exit_func is not None:
                 on_exit_func()
@@ -212,6 +466,10 @@ class Reply:
     def status_str(self):
         if self.timedout:
             return "REQUEST TIMEOUT"
+        if self.cancelled:
+            return "REQUEST CANCELLED"
+        if self.failed:
+            return self.fail_reason
 
         status_str = {
             0: "SUCCESS",
@@ -230,19 +488,56 @@ def call_factory(
     msg_name: str,
     msg_cls: t.Any
 ):
-    def call_func(*args, **kwargs):
+    def request_func(*args, **kwargs):
+        """Builds the (unsent) request for the call.
+        """
         no_reply = kwargs.pop('no_reply', False)
+        deadline = kwargs.pop('deadline', None)
+        cancel_token = kwargs.pop('cancel_token', None)
+        idempotent = kwargs.pop('idempotent', False)
         msg_inst = msg_cls(*args, **kwargs)
-        req = Request(frame_cls,
-                      conn,
-                      callset_name,
-                      callset_cls,
-                      msg_name,
-                      msg_inst,
-                      no_reply=no_reply)
-        req.send_sync()
+        return Request(frame_cls,
+                       conn,
+                       callset_name,
+                       callset_cls,
+                       msg_name,
+                       msg_inst,
+                       no_reply=no_reply,
+                       deadline=deadline,
+                       cancel_token=cancel_token,
+                       idempotent=idempotent)
+
+    def call_func(*args, **kwargs):
+        recorder = kwargs.pop('recorder', None)
+        timeout = kwargs.pop('timeout', 3)
+        req = request_func(*args, **kwargs)
+        req.send_sync(timeout)
+        if recorder is not None and not req.no_reply:
+            recorder.append(req.reply)
         return req.reply
+
+    async def call_async(*args, **kwargs):
+        recorder = kwargs.pop('recorder', None)
+        timeout = kwargs.pop('timeout', 3)
+        req = request_func(*args, **kwargs)
+        reply = await req.send_async(timeout)
+        if recorder is not None and not req.no_reply:
+            recorder.append(reply)
+        return reply
+
+    def fanout(*args, **kwargs):
+        """Sends the call to a device group (FanoutConnection), returning
+        {addr: Reply}.
+        """
+        timeout = kwargs.pop('timeout', 1.0)
+        expected = kwargs.pop('expected', None)
+        req = request_func(*args, **kwargs)
+        return conn.gather(req, timeout, expected)
+
     call_func.__name__ = msg_name.rstrip('_call')
+    call_func.request = request_func
+    call_func.call_async = call_async
+    call_func.fanout = fanout
     return call_func
 
 
@@ -255,6 +550,7 @@ class Api:
         self.callset_name = frame_callset.name
         self.callset_inst = frame_callset.cls()
         self.conn = conn
+        self.streams = {}
 
         for msg, frame_msg in frame_callset.msgs.items():
             setattr(self, msg, frame_msg)
@@ -269,3 +565,27 @@ class Api:
                                 msg,
                                 frame_msg.cls)
             setattr(self, func.__name__, func)
+
+    def stream(self, name):
+        """Gets the latest-value-wins StreamChannel for a call, starting it on
+        first use.
+        """
+        if name not in self.streams:
+            channel = StreamChannel(getattr(self, name))
+            channel.start()
+            self.streams[name] = channel
+        return self.streams[name]
+
+
+def make_api(frame_cls, conn) -> t.Dict[str, Api]:
+    """Builds the Api for each callset of the frame class, bound to conn.
+    """
+    parse_fields(frame_cls())
+    logger.debug(f"FrameDict={FrameDict}")
+    conn.frame_cls = frame_cls
+
+    api = {}
+    for callset in FrameDict:
+        logger.debug(f"Building api for callset: '{callset}'")
+        api[callset] = Api(frame_cls, FrameDict[callset], conn)
+    return api
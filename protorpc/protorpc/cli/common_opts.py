@@ -6,6 +6,7 @@ import logging
 
 from protorpc import build_api
 from protorpc.cli import setup_logging
+from protorpc.connection.sockopts import PROFILES
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +22,11 @@ def cli_common_opts(func):
     @click.option("--ip", type=str, help="Device IP address.")
     @click.option("--port", type=int, help="RPC server port.")
     @click.option("--hostname", type=str, help="Device hostname.")
+    @click.option("--serial", type=str, help="Serial port (use a serial connection).")
+    @click.option("--baudrate", type=int, default=921600, help="Serial baudrate.")
+    @click.option("--profile", type=click.Choice(list(PROFILES)), default='default',
+                  help="Socket tuning profile.")
+    @click.option("--keepalive", is_flag=True, help="Enable TCP keepalive.")
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         return func(*args, **kwargs)
@@ -43,14 +49,23 @@ def cli_init(ctx, params):
         # app calling this function.
         from rpc.lib import RpcFrame
 
-        protocol = 'udp' if params.udp else 'tcp'
+        if params.serial:
+            # Build the RPC api over a serial port.
+            api, conn = build_api(RpcFrame,
+                                  protocol='serial',
+                                  serial_port=params.serial,
+                                  baudrate=params.baudrate)
+        else:
+            protocol = 'udp' if params.udp else 'tcp'
 
-        # Build the RPC api and connection object.
-        api, conn = build_api(RpcFrame,
-                              protocol=protocol,
-                              port=params.port,
-                              addr=params.ip,
-                              hostname=params.hostname)
+            # Build the RPC api and connection object.
+            api, conn = build_api(RpcFrame,
+                                  protocol=protocol,
+                                  port=params.port,
+                                  addr=params.ip,
+                                  hostname=params.hostname,
+                                  profile=params.profile,
+                                  keepalive=params.keepalive)
     except Exception as e:
         logger.error("RPC api build error.")
         raise e
@@ -3,9 +3,15 @@ import datetime
 import logging
 import socket
 import typing as t
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from queue import Queue
 
+from protorpc.api import parse_header
+from protorpc.connection.codec import get_codec, DEFAULT_LEVEL, DEFAULT_THRESHOLD
+from protorpc.connection.sockopts import get_profile
+from protorpc.connection.writer import Writer
+from protorpc.connection.heartbeat import LinkHealth, Ping
+
 logger = logging.getLogger(__name__)
 
 
@@ -21,6 +27,13 @@ class BaseConnection(Thread):
     """Base connection class.
     """
 
+    # Connections over a network need an addr or hostname.
+    requires_addr = True
+
+    # When set, no_reply requests are sent as replied requests and tracked
+    # until acknowledged by their reply (see UdpConnection reliable mode).
+    ack_no_reply = False
+
     def __init__(self, name, *args, **kwargs):
 
         # Extract connection kwargs.
@@ -28,8 +41,23 @@ class BaseConnection(Thread):
         self.hostname = kwargs.pop('hostname', None)
         self.port = kwargs.pop('port', None)
         self.timeout = kwargs.pop('timeout', 2)
+        # Optional payload compression (both ends must enable it).
+        self.codec = get_codec(kwargs.pop('compress', False),
+                               level=kwargs.pop('compress_level', DEFAULT_LEVEL),
+                               threshold=kwargs.pop('compress_threshold', DEFAULT_THRESHOLD))
+        # Socket tuning profile and TCP keepalive (see sockopts).
+        self.profile = get_profile(kwargs.pop('profile', None))
+        self.keepalive = kwargs.pop('keepalive', None)
+        # Optional writer thread with a bounded send queue (see writer).
+        use_writer = kwargs.pop('writer', False)
+        # Ping the device when the link is idle for heartbeat seconds.
+        self.heartbeat = kwargs.pop('heartbeat', None)
+        self.heartbeat_timeout = kwargs.pop('heartbeat_timeout', 1.0)
+        writer_kwargs = dict(maxsize=kwargs.pop('writer_queue', 256),
+                             policy=kwargs.pop('backpressure', 'block'),
+                             max_batch=kwargs.pop('writer_batch', 64))
 
-        if all(item is None for item in [self.addr, self.hostname]):
+        if self.requires_addr and all(item is None for item in [self.addr, self.hostname]):
             raise Exception("Either 'addr' or 'hostname' must be provided.")
 
         # If IP addr is given, this takes precedence.
@@ -44,20 +72,37 @@ class BaseConnection(Thread):
         super().__init__(*args, **kwargs)
         self.name = name
         self.seqn = 0
+        # Seqns are allocated from caller, poller, writer and heartbeat threads.
+        self.seqn_lock = Lock()
 
-        self.pending_request = None
+        self.frame_cls = None
+        self.pending_requests = {}
+        self.pending_lock = Lock()
+        self.dropped_replies = 0
+        self.wakeup = Event()
         self.event = Event()
         self.daemon = True
+        self.writer = Writer(self, **writer_kwargs) if use_writer else None
+        self.health = LinkHealth()
+        self.last_ping = None
 
     def get_next_seqn(self):
         """Iterates and returns the sequence number.
         """
-        self.seqn += 1
-        return self.seqn
+        with self.seqn_lock:
+            self.seqn += 1
+            return self.seqn
 
     def shutdown(self):
         pass
 
+    def start(self):
+        """Starts the connection thread (and writer thread, if enabled).
+        """
+        super().start()
+        if self.writer is not None:
+            self.writer.start()
+
     def stop(self):
         """Stops the connection service.
         """
@@ -66,8 +111,13 @@ class BaseConnection(Thread):
     def close(self):
         """Close the connection.
         """
+        # Flush queued writes first.
+        if self.writer is not None:
+            self.writer.close()
         self.stop()
-        self.join()
+        # Not started if never connected.
+        if self.ident is not None:
+            self.join()
 
     def bytes_to_hex(self, data: bytes, clamp=None) -> str:
         """Converts a bytes stream to hex chars.
@@ -78,20 +128,168 @@ class BaseConnection(Thread):
             return ''.join(hex_str) + '...'
         return ''.join(hex_str)
 
+    @property
+    def is_reconnecting(self):
+        """True while a lost link is being re-established.
+        """
+        return False
+
+    def check_link(self):
+        """Services the link state from the connection thread (e.g. reconnect).
+        """
+        pass
+
+    def queue_replay(self, request):
+        """Queues an idempotent request whose write failed on link loss, to be
+        replayed once the link is re-established.  Returns False if the
+        connection does not reconnect (or is no longer reconnecting).
+        """
+        return False
+
+    def fail_pending(self, keep_idempotent=False):
+        """Fails pending requests on link loss, optionally keeping idempotent
+        ones for replay.  Returns the requests kept.
+        """
+        with self.pending_lock:
+            requests = list(self.pending_requests.values())
+            kept = [r for r in requests if keep_idempotent and r.idempotent]
+            self.pending_requests = {r.seqn: r for r in kept}
+
+        for request in requests:
+            if request not in kept:
+                logger.debug(f"Failing request seqn={request.seqn} (link lost).")
+                request.set_failed()
+        return kept
+
+    def send_ping(self, timeout=None):
+        """Sends a ping frame, returning the Ping (its done_event is set on
+        reply or loss).  Requires frame_cls (set when the api is built).
+        """
+        if self.frame_cls is None:
+            raise RuntimeError("Ping requires frame_cls; build the api first.")
+        ping = Ping(self, self.heartbeat_timeout if timeout is None else timeout)
+        self.last_ping = ping
+        ping.send()
+        return ping
+
+    def ping(self, timeout=None):
+        """Pings the device, returning the RTT in seconds (None if lost).
+        Waits at most a second past the ping timeout, in case the connection
+        thread is no longer servicing timeouts.
+        """
+        ping = self.send_ping(timeout)
+        remaining = (ping.ttl - datetime.datetime.now()).total_seconds()
+        if not ping.done_event.wait(max(remaining, 0) + 1.0):
+            if self.remove_pending(ping.seqn) is not None:
+                ping.set_timedout()
+        return ping.rtt
+
+    def check_heartbeat(self):
+        """Sends a ping from the connection thread when the link has been
+        idle for the heartbeat interval.
+        """
+        if self.heartbeat is None or self.frame_cls is None or not self.is_connected:
+            return
+        if self.last_ping is not None and not self.last_ping.done_event.is_set():
+            return
+        idle = self.health.idle_time
+        if self.last_ping is not None:
+            since_ping = time.perf_counter() - self.last_ping.t_sent
+            idle = since_ping if idle is None else min(idle, since_ping)
+        if idle is None or idle >= self.heartbeat:
+            try:
+                self.send_ping()
+            except Exception as e:
+                logger.debug(f"Heartbeat ping failed: {str(e)}")
+
+    def write_many(self, datas):
+        """Sends several payloads, returning the list of codec stats.
+        Subclasses may send them with fewer syscalls.
+        """
+        return [self.write(data) for data in datas]
+
     def add_pending(self, request):
         """Adds a request to the pending list.
         """
-        self.pending_request = request
+        self.frame_cls = type(request.frame)
+        with self.pending_lock:
+            self.pending_requests[request.seqn] = request
+        self.wakeup.set()
 
-    #def remove_pending(self, seqn):
-    #    """Removes a request to the pending list.
-    #    """
-    #    for r_seqn in self.pending_requests:
-    #        if r_seqn == seqn:
-    #            logger.debug(f"Removing seqn={seqn} from pending list.")
-    #            self.pending_requests.pop(seqn)
     def remove_pending(self, seqn):
-        self.pending_request = None
+        """Removes a request from the pending list, returning it (or None).
+        """
+        with self.pending_lock:
+            request = self.pending_requests.pop(seqn, None)
+        if request is not None:
+            logger.debug(f"Removing seqn={seqn} from pending list.")
+        return request
+
+    def dispatch(self, data):
+        """Routes a received frame to the pending request matching its seqn.
+        """
+        sample = None
+        try:
+            if self.codec is not None:
+                data, sample = self.codec.decode(data)
+            header = parse_header(self.frame_cls, data)
+        except Exception as e:
+            logger.error(f"Error decoding frame header, dropping frame: {str(e)}.")
+            return
+
+        self.health.seen()
+
+        request = self.remove_pending(header.seqn)
+        if request is None:
+            # Late reply for a cancelled or timed out request.
+            logger.debug(f"Dropping reply for unknown seqn={header.seqn}.")
+            self.dropped_replies += 1
+            return
+
+        self.reply_received(request)
+
+        try:
+            if self.codec is not None and request.reply is not None:
+                request.reply.codec_stats = sample
+            request.handle_reply(data)
+            logger.debug(f"Got reply for seqn={header.seqn}")
+        except Exception as e:
+            logger.error("Error receiving data, "
+                         f"dropping request with seqn={header.seqn}: {str(e)}.")
+            request.set_timedout()
+
+    def oversize_frame(self, head):
+        """Fails the request whose reply was dropped as oversize by the
+        deframer (given the decoded start of the reply), rather than letting
+        it time out.
+        """
+        if self.frame_cls is None:
+            return
+        if self.codec is not None:
+            head = self.codec.decode_head(head)
+        header = parse_header(self.frame_cls, head)
+        request = self.remove_pending(header.seqn)
+        if request is not None:
+            logger.error(f"Reply for seqn={header.seqn} exceeds max_frame_len.")
+            request.set_failed("REPLY TOO LARGE")
+
+    def reply_received(self, request):
+        """Called when a received frame is matched to a pending request.
+        """
+        pass
+
+    def check_timeouts(self):
+        """Removes pending requests which are past their ttl.
+        """
+        now = datetime.datetime.now()
+        with self.pending_lock:
+            expired = [r for r in self.pending_requests.values() if now > r.ttl]
+            for request in expired:
+                self.pending_requests.pop(request.seqn)
+
+        for request in expired:
+            logger.error(f"Removing request frame due to timeout: {request.frame}")
+            request.set_timedout()
 
     def read_loop(self):
         """Read from port.  Must be implemented by subclass.
@@ -108,30 +306,21 @@ class BaseConnection(Thread):
                 logger.debug("Base thread stopping.")
                 break
 
-            if self.pending_request is not None:
+            self.check_link()
+            self.check_heartbeat()
+
+            if self.pending_requests:
                 data = self.read_loop()
 
                 if data is not None:
-                    reply = self.pending_request.reply
-                    try:
-                        reply.rcv_handler(data)
-                        if reply.seqn == self.pending_request.seqn:
-                            logger.debug(f"Got reply for seqn={reply.seqn}")
-                            self.pending_request.got_reply = True
-                            self.remove_pending(reply.seqn)
-                            continue
-                    except Exception as e:
-                        logger.error("Error receiving data, "
-                                     "dropping request with "
-                                     f"seqn={self.pending_request.seqn}: {str(e)}.")
-                        self.remove_pending(0)
-                        continue
+                    self.dispatch(data)
 
                 # Test for pending request timeout.
-                if datetime.datetime.now() > self.pending_request.ttl:
-                    logger.error("Removing request frame due to timeout: "
-                                 f"{self.pending_request.frame}")
-                    self.pending_request.timedout = True
-                    self.remove_pending(0)
+                self.check_timeouts()
+
+                if data is not None:
+                    continue
 
-            time.sleep(0.1)
+            # Sleep until a request is added (or poll interval elapses).
+            self.wakeup.wait(0.1 if self.heartbeat is None else min(0.1, self.heartbeat))
+            self.wakeup.clear()
@@ -1,18 +1,196 @@
-import queue
+import re
 import typing as t
 import logging
 
-from queue import Queue
 from rich.logging import RichHandler
 
 logger = logging.getLogger(__name__)
 
 ESCAPED_BYTE = 0x00
+MAX_BLOCK = 254
+# Matches the fragment reassembly limit, so replies fitting one fit the other.
+DEFAULT_MAX_FRAME_LEN = 1024 * 1024
+# Encoded bytes of a dropped (oversize) frame passed to Deframer.on_oversize.
+HEAD_LEN = 256
+
+
+def max_encoded_len(length: int) -> int:
+    """Gets the maximum COBS encoded size of a payload (without delimiters).
+    """
+    return length + length // MAX_BLOCK + 1
+
+
+def max_framed_len(length: int) -> int:
+    """Gets the maximum size of a framed payload (with both delimiters).
+    """
+    return max_encoded_len(length) + 2
+
+
+# Code word for a run of n non-zero bytes (n < MAX_BLOCK) is _RUN_CODES[n].
+_RUN_CODES = [bytes([n + 1]) for n in range(MAX_BLOCK + 1)]
+_FULL_BLOCK_CODE = bytes([MAX_BLOCK + 1])
+_NON_ZERO_RUN = re.compile(b'[^\x00]+')
+
+
+def _encode_runs(src: bytes) -> t.ByteString:
+    """COBS encodes a payload (without delimiters).
+
+    The work is done by bytes methods rather than per byte.  When zeros make
+    up over 3/4 of the payload, zeros are replaced by the empty run code word
+    (1) and only the code words of non-empty runs are written.  Otherwise the
+    payload is split on zeros and the runs joined with their code words.
+    Runs of MAX_BLOCK or more bytes are split into full blocks.
+    """
+    if 4 * src.count(ESCAPED_BYTE) > 3 * len(src):
+        out = bytearray(_RUN_CODES[0])
+        out += src.replace(b'\x00', _RUN_CODES[0])
+        for match in _NON_ZERO_RUN.finditer(src):
+            start, end = match.span()
+            if end - start >= MAX_BLOCK:
+                break
+            # The code word replaces the zero preceding the run.
+            out[start] = end - start + 1
+        else:
+            return out
+
+    runs = src.split(b'\x00')
+    short = len(src) < MAX_BLOCK
+    # Runs of a payload shorter than a block need no length check.
+    lens = map(len, runs) if short else list(map(len, runs))
+    if short or max(lens) < MAX_BLOCK:
+        pieces = [None] * (2 * len(runs))
+        pieces[0::2] = map(_RUN_CODES.__getitem__, lens)
+        pieces[1::2] = runs
+        return b''.join(pieces)
+
+    pieces = []
+    last = len(runs) - 1
+    for idx, run in enumerate(runs):
+        num = lens[idx]
+        pos = 0
+        # Full blocks of 254 non-zero bytes (code word 255, no zero implied).
+        while num - pos >= MAX_BLOCK:
+            pieces.append(_FULL_BLOCK_CODE)
+            pieces.append(run[pos:pos + MAX_BLOCK])
+            pos += MAX_BLOCK
+        # The remaining block is terminated by the (possibly implicit) zero.
+        # A final run ending exactly on a full block needs no extra code word.
+        if idx < last or pos < num or num == 0:
+            pieces.append(_RUN_CODES[num - pos])
+            pieces.append(run[pos:])
+    return b''.join(pieces)
+
+
+def encode_into(bytes_in: t.ByteString, dst, framed=True) -> int:
+    """COBS encodes into a caller owned buffer (bytearray or writable
+    memoryview).  When framed, the leading and trailing delimiters are written
+    as well.  Returns the number of bytes written.
+    """
+    src = bytes_in if isinstance(bytes_in, (bytes, bytearray)) else bytes(bytes_in)
+    length = len(src)
+    if len(dst) < max_framed_len(length):
+        raise ValueError(f"COBS output buffer too small ({len(dst)}) "
+                         f"for payload[{length}].")
+
+    enc = _encode_runs(src)
+    out = 0
+
+    if framed:
+        dst[out] = ESCAPED_BYTE
+        out += 1
+
+    dst[out:out + len(enc)] = enc
+    out += len(enc)
+
+    if framed:
+        dst[out] = ESCAPED_BYTE
+        out += 1
+
+    return out
+
+
+def decode_into(encbytes_in: t.ByteString, dst) -> int:
+    """COBS decodes a frame (without delimiters) into a caller owned buffer of
+    at least len(encbytes_in) bytes.  Returns the decoded length.
+
+    Only the code words are visited.  Those standing for a zero are replaced
+    in a copy of the frame, which is then copied out in as few slices as
+    possible: one, unless the frame has full blocks, whose following code
+    word implies no zero and is skipped.
+    """
+    buf = bytearray(encbytes_in)
+    length = len(buf)
+    if len(dst) < length:
+        raise ValueError(f"COBS output buffer too small ({len(dst)}) "
+                         f"for frame[{length}].")
+
+    view = memoryview(buf)
+    out = 0
+    start = 0
+    code_idx = 0
+    # The first code word implies no zero.
+    skip = True
+
+    while code_idx < length:
+        code = buf[code_idx]
+        if code == ESCAPED_BYTE or code_idx + code > length:
+            raise ValueError(f"Invalid COBS code word {code} at index {code_idx}.")
+
+        if skip:
+            num = code_idx - start
+            dst[out:out + num] = view[start:code_idx]
+            out += num
+            start = code_idx + 1
+        else:
+            buf[code_idx] = ESCAPED_BYTE
+
+        # No zero follows a full block.
+        skip = code == MAX_BLOCK + 1
+        code_idx += code
+
+    num = length - start
+    dst[out:out + num] = view[start:length]
+    return out + num
 
 
 def encode(bytes_in: t.ByteString) -> t.ByteString:
     """Perform COBS encoding on the input byte stream.
     """
+    src = bytes_in if isinstance(bytes_in, (bytes, bytearray)) else bytes(bytes_in)
+    return bytearray(_encode_runs(src))
+
+
+def decode(encbytes_in: t.ByteString) -> t.ByteString:
+    """Perform COBS decoding on the input byte stream.
+    """
+    dec_out = bytearray(len(encbytes_in))
+    length = decode_into(encbytes_in, dec_out)
+    del dec_out[length:]
+    return dec_out
+
+
+def decode_head(encbytes_in: t.ByteString) -> bytearray:
+    """Decodes the start of a frame which is not decoded in full (e.g. the
+    first HEAD_LEN bytes of an oversize frame).  A block cut short is
+    truncated.
+    """
+    enc = bytes(encbytes_in)
+    out = bytearray()
+    idx = 0
+    while idx < len(enc):
+        code = enc[idx]
+        if code == ESCAPED_BYTE:
+            raise ValueError(f"Zero byte found in input at idx {idx}")
+        out += enc[idx + 1:idx + code]
+        idx += code
+        if code <= MAX_BLOCK and idx < len(enc):
+            out.append(ESCAPED_BYTE)
+    return out
+
+
+def encode_bytewise(bytes_in: t.ByteString) -> t.ByteString:
+    """Byte at a time COBS encoder (reference for the self test).
+    """
     max_overhead = round(len(bytes_in)/254 + 0.5)
     enc_out = [0] * (max_overhead + len(bytes_in))
     count = 0
@@ -47,8 +225,8 @@ def encode(bytes_in: t.ByteString) -> t.ByteString:
     return bytearray(enc_out)
 
 
-def decode(encbytes_in: t.ByteString) -> t.ByteString:
-    """Perform COBS decoding on the input byte stream.
+def decode_bytewise(encbytes_in: t.ByteString) -> t.ByteString:
+    """Byte at a time COBS decoder (reference for the self test).
     """
     dec_out = [0] * len(encbytes_in)
     code_idx = 0
@@ -86,75 +264,123 @@ def decode(encbytes_in: t.ByteString) -> t.ByteString:
     return bytearray(dec_out[:num])
 
 
-class Deframer:
-    def __init__(self):
-        self.state = "INIT"
-        self.q = Queue()
-        self.data = []
-        self.count = 0
+class FrameBuffer:
+    """Reusable scratch buffer for encoding and framing outgoing payloads.
+    Not thread safe; callers serialize access (e.g. with a write lock).
+    """
 
-    def process(self, new_data):
-        """Processes new data, returns decoded message if framing detected.
+    def __init__(self, size=2048):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+
+    def frame(self, *datas: t.ByteString) -> memoryview:
+        """COBS encodes and frames payloads back to back, growing the buffer
+        if needed.  The returned view is valid until the next call.
         """
-        # Push new data into the queue.
-        for b in new_data:
-            self.q.put_nowait(b)
+        size = sum(max_framed_len(len(data)) for data in datas)
+        if size > len(self.buf):
+            self.buf = bytearray(max(size, 2 * len(self.buf)))
+            self.view = memoryview(self.buf)
 
-        while True:
+        length = 0
+        for data in datas:
+            length += encode_into(data, self.view[length:])
+        return self.view[:length]
 
-            if self.state == "INIT":
-                logger.debug("DEFRAMER: INIT")
-                self.data = []
-                self.count = 0
-                self.state = "FIND_SOF"
 
-            elif self.state == "FIND_SOF":
-                while True:
-                    try:
-                        byte = self.q.get_nowait()
-                    except queue.Empty:
-                        logger.debug("DEFRAMER: FIND_SOF: fifo empty")
-                        self.state = "INIT"
-                        return None
-                    except Exception as e:
-                        logger.error(f"{str(e)}")
-                        self.state = "INIT"
-                        return None
-
-                    if byte == 0:
-                        logger.debug("DEFRAMER: FIND_SOF: Found framing.")
-                        self.state = "FIND_EOF"
-                        break
-
-            elif self.state == "FIND_EOF":
-                if self.q.empty():
-                    self.state = "INIT"
-                    return None
-
-                while True:
+class Deframer:
+    """Stream deframer for zero delimited COBS frames.
+
+    Received chunks are appended to a bytearray buffer and delimiters are
+    located with find(), so every complete frame in a chunk is returned at
+    once.  Bytes preceding the first delimiter are discarded; the partial frame
+    following the last delimiter is kept for the next chunk.
+
+    Frames longer than max_frame_len (encoded, without delimiters) are dropped.
+    If a frame in progress exceeds the limit, its bytes are discarded and the
+    deframer resyncs at the next delimiter, so the buffer never grows past
+    max_frame_len plus one received chunk.  The decoded start of each dropped
+    frame is passed to on_oversize (if set), so its request can be failed.
+    """
+
+    def __init__(self, max_frame_len=DEFAULT_MAX_FRAME_LEN, on_oversize=None):
+        self.max_frame_len = max_frame_len
+        self.on_oversize = on_oversize
+        self.buf = bytearray()
+        self.synced = False
+        self.errors = 0
+        self.oversize_frames = 0
+        self.garbage_bytes = 0
+        self.largest_frame = 0
+
+    def process(self, new_data):
+        """Processes new data, returns the list of decoded messages for all
+        complete frames.
+        """
+        buf = self.buf
+        msgs = []
+        pos = 0
+
+        buf += new_data
+
+        if not self.synced:
+            idx = buf.find(ESCAPED_BYTE)
+            if idx < 0:
+                logger.debug(f"DEFRAMER: discarding {len(buf)} bytes before SOF.")
+                self.garbage_bytes += len(buf)
+                buf.clear()
+                return msgs
+            self.garbage_bytes += idx
+            self.synced = True
+            pos = idx + 1
+
+        with memoryview(buf) as view:
+            while True:
+                idx = buf.find(ESCAPED_BYTE, pos)
+                if idx < 0:
+                    break
+
+                if idx - pos > self.max_frame_len:
+                    logger.error(f"DEFRAMER: dropping oversize frame[{idx - pos}].")
+                    self.oversize_frames += 1
+                    self.garbage_bytes += idx - pos
+                    self.report_oversize(view[pos:pos + HEAD_LEN])
+                # Back to back delimiters enclose no frame.
+                elif idx > pos:
+                    self.largest_frame = max(self.largest_frame, idx - pos + 2)
                     try:
-                        byte = self.q.get_nowait()
-                    except queue.Empty:
-                        logger.debug("DEFRAMER: FIND_EOF: fifo empty.")
-                        self.state = "INIT"
-                        return None
-                    except Exception as e:
-                        logger.error(f"{str(e)}")
-                        self.state = "INIT"
-                        return None
-
-                    if byte == 0:
-                        logger.debug(f"DEFRAMER: FIND_EOF: Found framing. count={self.count}")
-                        self.state = "DECODE"
-                        break
-                    else:
-                        self.data.append(byte)
-                        self.count += 1
-
-            elif self.state == "DECODE":
-                logger.debug("DEFRAMER: DECODE")
-                self.state = "INIT"
-                return decode(bytearray(self.data))
+                        msgs.append(decode(view[pos:idx]))
+                    except ValueError as e:
+                        logger.error(f"DEFRAMER: dropping frame: {str(e)}")
+                        self.errors += 1
+                        self.garbage_bytes += idx - pos
+                pos = idx + 1
+
+        if len(buf) - pos > self.max_frame_len:
+            # Frame in progress is oversize, drop it and resync.
+            logger.error(f"DEFRAMER: dropping oversize frame[{len(buf) - pos}+], resyncing.")
+            self.oversize_frames += 1
+            self.garbage_bytes += len(buf) - pos
+            self.report_oversize(buf[pos:pos + HEAD_LEN])
+            self.synced = False
+            buf.clear()
+        else:
+            # Drop consumed bytes (bytearray trims the front in place).
+            del buf[:pos]
+
+        if msgs:
+            logger.debug(f"DEFRAMER: {len(msgs)} frames, {len(buf)} bytes pending.")
+        return msgs
+
+    def report_oversize(self, head):
+        """Passes the decoded start of a dropped frame to on_oversize.
+        """
+        if self.on_oversize is None:
+            return
+        try:
+            self.on_oversize(decode_head(head))
+        except Exception as e:
+            logger.debug(f"DEFRAMER: oversize frame head not handled: {str(e)}")
 
 
 if __name__ == "__main__":
@@ -230,3 +456,48 @@ if __name__ == "__main__":
         logger.error(f"dec={list(dec)}")
     else:
         logger.info(f"Pass: msg={msg[:16]}")
+
+    # Compatibility with the byte at a time implementation.  The bytewise
+    # encoder fails on empty input and emits a zero byte when a zero is the
+    # 255th byte of a run, so for those inputs only the round trip is checked.
+    import random
+
+    vectors = [[], [0] * 3]
+    for n in [1, 253, 254, 255, 256, 507, 508, 509, 762]:
+        run = [(x % 255) + 1 for x in range(n)]
+        vectors += [run, run + [0], [0] + run, [0] + run + [0], run + [0] + run]
+    for pos in [252, 253, 254, 255, 256]:
+        msg = [(x % 255) + 1 for x in range(600)]
+        msg[pos] = 0
+        vectors.append(msg)
+    rnd = random.Random(0)
+    for density in [0.0, 0.01, 0.1, 0.5, 1.0]:
+        for _ in range(50):
+            n = rnd.randrange(0, 1200)
+            vectors.append([0 if rnd.random() < density else rnd.randrange(1, 256)
+                            for _ in range(n)])
+
+    failures = 0
+    for msg in vectors:
+        enc = encode(bytearray(msg))
+        ok = (ESCAPED_BYTE not in enc and
+              list(decode(enc)) == msg and
+              list(decode_bytewise(enc)) == msg and
+              list(decode_head(enc)) == msg and
+              all(msg[:len(head)] == list(head)
+                  for head in (decode_head(enc[:n]) for n in [1, 2, 254, 255, 256, HEAD_LEN])))
+        try:
+            ref = encode_bytewise(bytearray(msg))
+        except IndexError:
+            ref = None
+        if ref is not None and ESCAPED_BYTE not in ref:
+            ok = ok and enc == ref and list(decode(ref)) == msg
+        if not ok:
+            failures += 1
+            logger.error(f"Compat fail: msg[{len(msg)}]={msg[:16]}")
+            logger.error(f"enc={list(enc)[:16]}")
+
+    if failures:
+        logger.error(f"Compat: {failures} of {len(vectors)} vectors failed.")
+    else:
+        logger.info(f"Compat pass: {len(vectors)} vectors.")
@@ -0,0 +1,175 @@
+# Batch COBS encoding/decoding of many frames at once using numpy.
+#
+# Frames are passed either as a list of payloads or as one concatenated buffer
+# plus an offsets array (frame i spans buf[offsets[i]:offsets[i + 1]]).
+# Results are returned the same way: a single uint8 output buffer and an
+# offsets array.
+#
+import logging
+import typing as t
+
+import numpy as np
+
+from protorpc.connection.cobs import ESCAPED_BYTE, MAX_BLOCK
+
+logger = logging.getLogger(__name__)
+
+
+def _cumsum_excl(values):
+    """Exclusive cumulative sum (start offset of each element).
+    """
+    out = np.zeros(len(values), dtype=np.int64)
+    np.cumsum(values[:-1], out=out[1:])
+    return out
+
+
+def _ranks(counts):
+    """For each element repeated counts[i] times, its index within the repeat.
+    """
+    total = int(counts.sum())
+    return np.arange(total, dtype=np.int64) - np.repeat(_cumsum_excl(counts), counts)
+
+
+def as_batch(payloads, offsets=None) -> t.Tuple[np.ndarray, np.ndarray]:
+    """Converts a list of payloads (or a buffer + offsets) into a uint8 buffer
+    and int64 offsets array.
+    """
+    if offsets is None:
+        lengths = np.fromiter((len(p) for p in payloads), dtype=np.int64,
+                              count=len(payloads))
+        buf = np.frombuffer(b''.join(payloads), dtype=np.uint8)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return buf, offsets
+
+    if not isinstance(payloads, np.ndarray):
+        payloads = np.frombuffer(payloads, dtype=np.uint8)
+    return payloads, np.asarray(offsets, dtype=np.int64)
+
+
+def unbatch(buf, offsets) -> t.List[bytes]:
+    """Splits a batch buffer back into a list of frames.
+    """
+    data = buf.tobytes()
+    return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def encode_batch(payloads, offsets=None, framed=True) -> t.Tuple[np.ndarray, np.ndarray]:
+    """COBS encodes a batch of frames.  When framed, each encoded frame
+    includes its leading and trailing delimiters.
+    """
+    buf, offsets = as_batch(payloads, offsets)
+    num_frames = len(offsets) - 1
+    if num_frames <= 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64)
+
+    first, last = offsets[0], offsets[-1]
+    data = buf[first:last]
+
+    # Every run of non-zero bytes is terminated by a zero byte or by the
+    # (virtual) end of its frame.  Frame ends sort before a zero at the same
+    # position, which belongs to the next frame.
+    zeros = np.flatnonzero(data == ESCAPED_BYTE) + first
+    term = np.concatenate([zeros, offsets[1:]])
+    is_end = np.concatenate([np.zeros(len(zeros), dtype=bool),
+                             np.ones(num_frames, dtype=bool)])
+    order = np.argsort(2 * term + ~is_end, kind='stable')
+    term = term[order]
+    is_end = is_end[order]
+
+    # Run start follows the previous terminator (a zero is skipped).
+    starts = np.empty_like(term)
+    starts[0] = first
+    starts[1:] = term[:-1] + ~is_end[:-1]
+    run_len = term - starts
+
+    # Blocks per run: full 254 byte blocks plus a terminating block, which is
+    # omitted when a frame ends exactly on a full block.
+    full = run_len // MAX_BLOCK
+    rem = run_len - full * MAX_BLOCK
+    trailing = ~(is_end & (run_len > 0) & (rem == 0))
+    run_size = run_len + full + trailing
+
+    if framed:
+        before = np.empty(len(term), dtype=np.int64)
+        before[0] = 1
+        before[1:] = is_end[:-1]
+        after = is_end.astype(np.int64)
+    else:
+        before = after = np.zeros(len(term), dtype=np.int64)
+
+    run_end = np.cumsum(run_size + before + after)
+    run_out = run_end - run_size - after
+
+    # Output is zero initialized, so delimiters need not be written.
+    out = np.zeros(int(run_end[-1]), dtype=np.uint8)
+
+    # Data bytes: byte k of a run lands after k // 254 + 1 code words.
+    k = _ranks(run_len)
+    out[np.repeat(run_out, run_len) + k // MAX_BLOCK + 1 + k] = data[data != ESCAPED_BYTE]
+
+    # Full block code words.
+    out[np.repeat(run_out, full) + _ranks(full) * (MAX_BLOCK + 1)] = MAX_BLOCK + 1
+
+    # Terminating block code words.
+    out[run_out[trailing] + full[trailing] * (MAX_BLOCK + 1)] = rem[trailing] + 1
+
+    out_offsets = np.zeros(num_frames + 1, dtype=np.int64)
+    out_offsets[1:] = run_end[is_end]
+    return out, out_offsets
+
+
+def decode_batch(payloads, offsets=None, framed=True) -> t.Tuple[np.ndarray, np.ndarray]:
+    """COBS decodes a batch of frames.  When framed, each input frame is
+    expected to include its leading and trailing delimiters.
+    """
+    buf, offsets = as_batch(payloads, offsets)
+    num_frames = len(offsets) - 1
+    if num_frames <= 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64)
+
+    starts = offsets[:-1] + int(framed)
+    ends = offsets[1:] - int(framed)
+
+    # Follow the code word chain of all frames in lock step; the number of
+    # iterations is the largest number of blocks in any one frame.
+    code_pos = []
+    code_frame = []
+    cur = starts.copy()
+    active = np.flatnonzero(cur < ends)
+    while active.size:
+        pos = cur[active]
+        nxt = pos + buf[pos]
+        bad = (buf[pos] == ESCAPED_BYTE) | (nxt > ends[active])
+        if bad.any():
+            idx = active[np.argmax(bad)]
+            raise ValueError(f"Invalid COBS code word in frame {idx}.")
+        code_pos.append(pos)
+        code_frame.append(active)
+        cur[active] = nxt
+        active = active[nxt < ends[active]]
+
+    if not code_pos:
+        return np.zeros(0, dtype=np.uint8), np.zeros(num_frames + 1, dtype=np.int64)
+
+    pos = np.concatenate(code_pos)
+    frame = np.concatenate(code_frame)
+    order = np.argsort(pos, kind='stable')
+    pos = pos[order]
+    frame = frame[order]
+
+    code = buf[pos].astype(np.int64)
+    num = code - 1
+    # A zero follows every block except full blocks and the final block.
+    zero = (code != MAX_BLOCK + 1) & (pos + code < ends[frame])
+    block_len = num + zero
+    block_out = _cumsum_excl(block_len)
+
+    out = np.zeros(int(block_len.sum()), dtype=np.uint8)
+    k = _ranks(num)
+    out[np.repeat(block_out, num) + k] = buf[np.repeat(pos + 1, num) + k]
+
+    out_offsets = np.zeros(num_frames + 1, dtype=np.int64)
+    frame_len = np.bincount(frame, weights=block_len, minlength=num_frames)
+    np.cumsum(frame_len.astype(np.int64), out=out_offsets[1:])
+    return out, out_offsets
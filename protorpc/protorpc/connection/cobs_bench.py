@@ -0,0 +1,229 @@
+# COBS and framing benchmark and fuzz suite.
+#
+#   protorpc_cobs_bench bench   : encode/decode/deframe throughput.
+#   protorpc_cobs_bench fuzz    : randomized round trip tests.
+#
+import sys
+import time
+import random
+import logging
+import click
+from rich.console import Console
+from rich.table import Table
+
+import protorpc.connection.cobs as cobs
+from protorpc.cli import setup_logging, get_params
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+SIZES = [16, 64, 256, 1024, 4096, 16384]
+DENSITIES = [0.0, 0.01, 0.1, 0.3, 0.5, 0.7, 0.9]
+
+
+def make_payload(rnd, size, density):
+    """Random payload of size bytes, with zero bytes at the given density.
+    """
+    return bytes(0 if rnd.random() < density else rnd.randrange(1, 256)
+                 for _ in range(size))
+
+
+def make_stream(payloads):
+    """Concatenates framed payloads into one byte stream.
+    """
+    return b''.join(b'\x00' + bytes(cobs.encode(p)) + b'\x00' for p in payloads)
+
+
+def split_chunks(rnd, data, max_chunk):
+    """Splits data at random chunk boundaries.
+    """
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rnd.randint(1, max_chunk)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def measure(func, nbytes, min_time):
+    """Runs func repeatedly for at least min_time, returns throughput in MB/s.
+    """
+    count = 0
+    t_start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - t_start
+        if elapsed >= min_time:
+            return nbytes * count / elapsed / 1e6
+
+
+def get_cases(rnd, sizes, densities):
+    """Yields (size, density, payloads) for each benchmark case.  Small sizes
+    get more payloads so each case covers at least 64 KB.
+    """
+    for size in sizes:
+        for density in densities:
+            num = max(1, 65536 // size)
+            yield size, density, [make_payload(rnd, size, density) for _ in range(num)]
+
+
+def run_bench(sizes, densities, min_time, seed):
+    """Benchmarks codec and deframer throughput (MB/s of payload).
+    """
+    rnd = random.Random(seed)
+
+    try:
+        import protorpc.connection.cobs_batch as cobs_batch
+    except ImportError:
+        logger.info("numpy not available, skipping batch benchmarks.")
+        cobs_batch = None
+
+    table = Table(title="COBS throughput (MB/s)")
+    cols = ["size", "zeros", "encode", "decode", "encode_into", "deframe"]
+    if cobs_batch is not None:
+        cols += ["encode_batch", "decode_batch"]
+    for col in cols:
+        table.add_column(col, justify="right")
+
+    for size, density, payloads in get_cases(rnd, sizes, densities):
+        nbytes = size * len(payloads)
+        encoded = [cobs.encode(p) for p in payloads]
+        stream = make_stream(payloads)
+        dst = bytearray(cobs.max_framed_len(size))
+
+        def encode():
+            for p in payloads:
+                cobs.encode(p)
+
+        def decode():
+            for e in encoded:
+                cobs.decode(e)
+
+        def encode_into():
+            for p in payloads:
+                cobs.encode_into(p, dst)
+
+        def deframe():
+            cobs.Deframer().process(stream)
+
+        row = [str(size), f"{density:.0%}"]
+        row += [f"{measure(f, nbytes, min_time):.1f}"
+                for f in [encode, decode, encode_into, deframe]]
+
+        if cobs_batch is not None:
+            batch, offsets = cobs_batch.encode_batch(payloads)
+            row.append(f"{measure(lambda: cobs_batch.encode_batch(payloads), nbytes, min_time):.1f}")
+            row.append(f"{measure(lambda: cobs_batch.decode_batch(batch, offsets), nbytes, min_time):.1f}")
+
+        table.add_row(*row)
+
+    Console().print(table)
+
+
+def run_fuzz(iterations, max_size, seed):
+    """Randomized round trip tests.  Returns the number of failures.
+    """
+    rnd = random.Random(seed)
+    failures = 0
+
+    try:
+        import protorpc.connection.cobs_batch as cobs_batch
+    except ImportError:
+        logger.info("numpy not available, skipping batch fuzzing.")
+        cobs_batch = None
+
+    def fail(what, payload):
+        nonlocal failures
+        failures += 1
+        logger.error(f"{what} failed: payload[{len(payload)}]={payload[:32].hex()}")
+
+    for it in range(iterations):
+        # Favor sizes around block boundaries.
+        size = rnd.choice([rnd.randrange(0, max_size),
+                           rnd.choice([253, 254, 255, 256, 508, 509]) + rnd.randint(-2, 2)])
+        density = rnd.choice(DENSITIES + [1.0])
+        payload = make_payload(rnd, max(0, size), density)
+
+        enc = cobs.encode(payload)
+        if cobs.ESCAPED_BYTE in enc or bytes(cobs.decode(enc)) != payload:
+            fail("encode/decode", payload)
+            continue
+
+        dst = bytearray(cobs.max_framed_len(len(payload)))
+        length = cobs.encode_into(payload, memoryview(dst))
+        out = bytearray(len(enc))
+        if (dst[:length] != b'\x00' + enc + b'\x00' or
+                bytes(out[:cobs.decode_into(enc, out)]) != payload):
+            fail("encode_into/decode_into", payload)
+
+        if len(payload) < 600 and list(cobs.decode_bytewise(enc)) != list(payload):
+            fail("decode_bytewise", payload)
+
+        # Several frames, fed to the deframer split at random boundaries.
+        payloads = [payload] + [make_payload(rnd, rnd.randrange(0, 300), density)
+                                for _ in range(rnd.randrange(0, 4))]
+        stream = b'\x01\x02' + make_stream(payloads)
+        deframer = cobs.Deframer()
+        msgs = []
+        for chunk in split_chunks(rnd, stream, rnd.choice([1, 7, 64, 1500])):
+            msgs += deframer.process(chunk)
+        if [bytes(m) for m in msgs] != payloads or deframer.buf:
+            fail("deframer", payload)
+
+        if cobs_batch is not None:
+            batch, offsets = cobs_batch.encode_batch(payloads)
+            if cobs_batch.unbatch(batch, offsets) != [b'\x00' + bytes(cobs.encode(p)) + b'\x00'
+                                                      for p in payloads]:
+                fail("encode_batch", payload)
+            elif cobs_batch.unbatch(*cobs_batch.decode_batch(batch, offsets)) != payloads:
+                fail("decode_batch", payload)
+
+    logger.info(f"Fuzz: {iterations} iterations, {failures} failures.")
+    return failures
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+@click.option("--loglevel", default='info', help="Debug logging level.")
+@click.option("-d", "--debug", is_flag=True, help="Shortcut for --loglevel=debug.")
+@click.option("--seed", type=int, default=0, help="Random seed.")
+@click.pass_context
+def cli(ctx, **kwargs):
+    """COBS and framing benchmark and fuzz suite.
+    """
+    params = get_params(**kwargs)
+    loglevel = 'debug' if params.debug else params.loglevel
+    setup_logging(logging.getLogger(), level=loglevel)
+    ctx.obj = params
+
+
+@cli.command()
+@click.option("--size", type=int, multiple=True, help="Payload size (can provide multiple).")
+@click.option("--density", type=float, multiple=True, help="Zero byte density (can provide multiple).")
+@click.option("--min-time", type=float, default=0.2, help="Minimum time per measurement (s).")
+@click.pass_obj
+def bench(params, size, density, min_time):
+    """Measures encode/decode/deframe throughput.
+    """
+    run_bench(list(size) or SIZES, list(density) or DENSITIES, min_time, params.seed)
+
+
+@cli.command()
+@click.option("-n", "--iterations", type=int, default=2000, help="Number of iterations.")
+@click.option("--max-size", type=int, default=2048, help="Maximum payload size.")
+@click.pass_obj
+def fuzz(params, iterations, max_size):
+    """Randomized round trip tests (exits with 1 on failure).
+    """
+    if run_fuzz(iterations, max_size, params.seed):
+        sys.exit(1)
+
+
+def entrypoint():
+    cli()
+
+
+if __name__ == "__main__":
+    entrypoint()
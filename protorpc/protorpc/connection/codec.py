@@ -0,0 +1,113 @@
+import time
+import zlib
+import logging
+import typing as t
+from dataclasses import dataclass
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Frame flag byte values prefixed to each payload when compression is enabled.
+FLAG_RAW = 0x00
+FLAG_ZLIB = 0x01
+
+DEFAULT_LEVEL = 1
+DEFAULT_THRESHOLD = 256
+
+
+@dataclass
+class CodecSample:
+    size_in: int
+    size_out: int
+    cpu_time: float
+
+    @property
+    def ratio(self):
+        """Ratio of uncompressed to compressed size.
+        """
+        return self.size_in / self.size_out if self.size_out else 1.0
+
+
+class FrameCodec:
+    """Payload compression stage applied between serialization and framing.
+
+    Each payload is prefixed with a flag byte indicating whether the rest of
+    the frame is zlib compressed.  Payloads smaller than `threshold` (or which
+    do not shrink) are sent raw.  Both ends of the link must enable the codec.
+    encode() and decode() return the per-frame CodecSample along with the
+    data, as the codec is shared by the threads writing to the connection.
+    """
+
+    def __init__(self, level=DEFAULT_LEVEL, threshold=DEFAULT_THRESHOLD):
+        self.level = level
+        self.threshold = threshold
+        self.frames = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+        self.lock = Lock()
+
+    def _sample(self, size_in, size_out, t_start):
+        sample = CodecSample(size_in, size_out, time.thread_time() - t_start)
+        with self.lock:
+            self.cpu_time += sample.cpu_time
+        return sample
+
+    def encode(self, data: t.ByteString) -> t.Tuple[t.ByteString, CodecSample]:
+        """Compresses the payload (if worthwhile) and adds the flag byte.
+        Returns (data, sample).
+        """
+        t_start = time.thread_time()
+        out = None
+        if len(data) >= self.threshold:
+            compressed = zlib.compress(data, self.level)
+            if len(compressed) < len(data):
+                out = bytes([FLAG_ZLIB]) + compressed
+
+        if out is None:
+            out = bytes([FLAG_RAW]) + data
+
+        with self.lock:
+            self.frames += 1
+            self.compressed += out[0] == FLAG_ZLIB
+            self.bytes_in += len(data)
+            self.bytes_out += len(out)
+        return out, self._sample(len(data), len(out), t_start)
+
+    def decode(self, data: t.ByteString) -> t.Tuple[t.ByteString, CodecSample]:
+        """Strips the flag byte and decompresses the payload if needed.
+        Returns (data, sample).
+        """
+        t_start = time.thread_time()
+        flag = data[0]
+        if flag == FLAG_ZLIB:
+            out = zlib.decompress(data[1:])
+        elif flag == FLAG_RAW:
+            out = data[1:]
+        else:
+            raise ValueError(f"Unknown codec flag: 0x{flag:02x}")
+
+        return out, self._sample(len(out), len(data), t_start)
+
+    def decode_head(self, data: t.ByteString) -> t.ByteString:
+        """Decodes as much as possible of the start of an encoded frame (no
+        stats are recorded).
+        """
+        if data[0] == FLAG_ZLIB:
+            return zlib.decompressobj().decompress(bytes(data[1:]))
+        return data[1:]
+
+    @property
+    def ratio(self):
+        """Overall compression ratio of encoded frames.
+        """
+        return self.bytes_in / self.bytes_out if self.bytes_out else 1.0
+
+
+def get_codec(compress, **kwargs) -> t.Optional[FrameCodec]:
+    """Gets the codec for the connection 'compress' option (bool or codec).
+    """
+    if isinstance(compress, FrameCodec):
+        return compress
+    return FrameCodec(**kwargs) if compress else None
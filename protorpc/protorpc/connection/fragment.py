@@ -0,0 +1,147 @@
+# Fragmentation and reassembly of frames larger than one datagram.
+#
+# Fragment datagram layout (little endian):
+#   magic  : u8   FRAG_MAGIC
+#   seqn   : u32  fragmented frame id
+#   index  : u16  fragment index
+#   count  : u16  number of fragments
+#   offset : u32  offset of the fragment data in the frame
+#   total  : u32  frame length
+#   data   : fragment data
+#
+# FRAG_MAGIC (field 0, wire type 7) can never start a protobuf frame, and
+# differs from the zero delimiter starting packed datagrams.
+#
+import time
+import struct
+import logging
+import typing as t
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+FRAG_MAGIC = 0x07
+HEADER = struct.Struct('<BIHHII')
+HEADER_SIZE = HEADER.size
+MAX_FRAGMENTS = 0xffff
+DEFAULT_MAX_FRAME_LEN = 1024 * 1024
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_TIMEOUT = 2.0
+
+
+def fragment(seqn: int, data: t.ByteString, mtu: int) -> t.List[bytes]:
+    """Splits a frame into fragment datagrams of at most mtu bytes.
+    """
+    size = mtu - HEADER_SIZE
+    if size <= 0:
+        raise ValueError(f"mtu {mtu} too small for fragment header.")
+    count = (len(data) + size - 1) // size
+    if count > MAX_FRAGMENTS:
+        raise ValueError(f"Frame of {len(data)} bytes needs too many fragments.")
+
+    view = memoryview(data)
+    seqn &= 0xffffffff
+    return [HEADER.pack(FRAG_MAGIC, seqn, idx, count, offset, len(data)) +
+            view[offset:offset + size]
+            for idx, offset in enumerate(range(0, len(data), size))]
+
+
+class Partial:
+    """A frame being reassembled.
+    """
+
+    def __init__(self, count, total, t_first):
+        self.buf = bytearray(total)
+        self.view = memoryview(self.buf)
+        self.count = count
+        self.received = set()
+        self.t_first = t_first
+
+
+class Reassembler:
+    """Reassembles fragmented frames into a preallocated buffer per frame.
+
+    Frames longer than max_frame_len are dropped.  When the partial frames
+    exceed max_bytes in total, the oldest ones are dropped, as are those not
+    completed within timeout seconds (see expire()).
+    """
+
+    def __init__(self, max_frame_len=DEFAULT_MAX_FRAME_LEN, max_bytes=DEFAULT_MAX_BYTES,
+                 timeout=DEFAULT_TIMEOUT, clock=time.monotonic):
+        self.max_frame_len = max_frame_len
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.clock = clock
+        self.partials = OrderedDict()
+        self.pending_bytes = 0
+        # Stats.
+        self.reassembled = 0
+        self.dropped = 0
+        self.duplicates = 0
+        self.invalid = 0
+
+    def drop(self, key, reason):
+        partial = self.partials.pop(key)
+        self.pending_bytes -= len(partial.buf)
+        self.dropped += 1
+        logger.debug(f"Dropping fragmented frame seqn={key[1]}: {reason} "
+                     f"({len(partial.received)}/{partial.count} fragments).")
+
+    def add(self, datagram: t.ByteString, source=None) -> t.Optional[bytearray]:
+        """Adds a fragment datagram.  Returns the frame once complete.
+        """
+        if len(datagram) < HEADER_SIZE:
+            self.invalid += 1
+            return None
+        _, seqn, idx, count, offset, total = HEADER.unpack_from(datagram)
+        data = memoryview(datagram)[HEADER_SIZE:]
+
+        if idx >= count or offset + len(data) > total:
+            self.invalid += 1
+            logger.debug(f"Invalid fragment seqn={seqn} index={idx}/{count}.")
+            return None
+        if total > self.max_frame_len:
+            self.dropped += 1
+            logger.warning(f"Dropping fragmented frame seqn={seqn}: {total} bytes "
+                           f"exceeds max_frame_len={self.max_frame_len}.")
+            return None
+
+        key = (source, seqn)
+        partial = self.partials.get(key)
+        if partial is None:
+            if count == 1:
+                self.reassembled += 1
+                return bytearray(data)
+            while self.partials and self.pending_bytes + total > self.max_bytes:
+                self.drop(next(iter(self.partials)), "memory limit")
+            partial = Partial(count, total, self.clock())
+            self.partials[key] = partial
+            self.pending_bytes += total
+        elif partial.count != count or len(partial.buf) != total:
+            self.invalid += 1
+            return None
+
+        if idx in partial.received:
+            self.duplicates += 1
+            return None
+        partial.view[offset:offset + len(data)] = data
+        partial.received.add(idx)
+
+        if len(partial.received) < partial.count:
+            return None
+
+        del self.partials[key]
+        self.pending_bytes -= total
+        self.reassembled += 1
+        return partial.buf
+
+    def expire(self):
+        """Drops partial frames older than timeout.
+        """
+        now = self.clock()
+        # Partials are kept in arrival order.
+        while self.partials:
+            key, partial = next(iter(self.partials.items()))
+            if now - partial.t_first <= self.timeout:
+                break
+            self.drop(key, "timeout")
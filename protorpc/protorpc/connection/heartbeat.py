@@ -0,0 +1,134 @@
+# Link heartbeat: header-only ping frames and link health statistics.
+#
+# A ping is a frame with only the header set (seqn, no callset).  The device
+# resolver has nothing to dispatch and replies with the same seqn (status
+# BAD_RESOLVER_LOOKUP), which serves as the echo.  Any reply counts.
+#
+import time
+import datetime
+import logging
+from collections import deque
+from threading import Event, Lock
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 100
+
+
+class LinkHealth:
+    """RTT and loss statistics for a connection, over the last window pings.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, clock=time.monotonic):
+        self.clock = clock
+        self.lock = Lock()
+        self.rtts = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.sent = 0
+        self.lost = 0
+        self.last_rtt = None
+        self.last_seen = None
+
+    def seen(self):
+        """Records that a frame was received from the device.
+        """
+        self.last_seen = self.clock()
+
+    def record_rtt(self, rtt):
+        with self.lock:
+            self.rtts.append(rtt)
+            self.outcomes.append(True)
+            self.last_rtt = rtt
+
+    def record_loss(self):
+        with self.lock:
+            self.outcomes.append(False)
+            self.lost += 1
+
+    @property
+    def loss_rate(self):
+        """Fraction of recent pings without a reply.
+        """
+        with self.lock:
+            if not self.outcomes:
+                return 0.0
+            return self.outcomes.count(False) / len(self.outcomes)
+
+    @property
+    def idle_time(self):
+        """Seconds since a frame was last received (None if never).
+        """
+        if self.last_seen is None:
+            return None
+        return self.clock() - self.last_seen
+
+    def percentile(self, pct):
+        """RTT percentile (0 to 100) over recent pings, None if no samples.
+        """
+        with self.lock:
+            rtts = sorted(self.rtts)
+        if not rtts:
+            return None
+        idx = min(len(rtts) - 1, int(round(pct / 100 * (len(rtts) - 1))))
+        return rtts[idx]
+
+    def summary(self):
+        """Returns the health statistics as a dict.
+        """
+        return {
+            'sent': self.sent,
+            'lost': self.lost,
+            'loss_rate': self.loss_rate,
+            'rtt_last': self.last_rtt,
+            'rtt_p50': self.percentile(50),
+            'rtt_p90': self.percentile(90),
+            'rtt_p99': self.percentile(99),
+            'idle_time': self.idle_time,
+        }
+
+
+class Ping:
+    """A header-only ping frame, tracked in the connection pending list like
+    a request.
+    """
+
+    idempotent = False
+    retransmit = False
+    reply = None
+
+    def __init__(self, conn, timeout):
+        self.conn = conn
+        self.health = conn.health
+        self.seqn = conn.get_next_seqn()
+        self.frame = conn.frame_cls()
+        self.frame.header.seqn = self.seqn
+        self.ser = bytes(self.frame)
+        self.ttl = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+        self.rtt = None
+        self.done_event = Event()
+        self.t_sent = None
+
+    def send(self):
+        self.conn.add_pending(self)
+        self.t_sent = time.perf_counter()
+        self.health.sent += 1
+        try:
+            self.conn.write(self.ser)
+        except Exception:
+            self.conn.remove_pending(self.seqn)
+            self.set_failed()
+            raise
+
+    def handle_reply(self, data):
+        self.rtt = time.perf_counter() - self.t_sent
+        self.health.record_rtt(self.rtt)
+        logger.debug(f"Ping seqn={self.seqn} rtt={1e3 * self.rtt:.3f}ms")
+        self.done_event.set()
+
+    def set_timedout(self):
+        logger.debug(f"Ping seqn={self.seqn} lost.")
+        self.health.record_loss()
+        self.done_event.set()
+
+    def set_failed(self, reason=None):
+        self.set_timedout()
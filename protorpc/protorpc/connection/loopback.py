@@ -0,0 +1,169 @@
+# In-process loopback transport.
+#
+# LoopbackConnection is a TcpConnection over one end of a socketpair; a
+# LoopbackServer serves the other end in a thread, dispatching calls to
+# Python handlers.  The full client path (request construction,
+# serialization, codec, COBS framing, reply routing) runs without a network
+# or device, e.g. for tests and benchmarks:
+#
+#   server = LoopbackServer(RpcFrame)
+#   server.register('test_callset', 'get_value', lambda call: {'value': 1.0})
+#   api, conn = build_api(RpcFrame, protocol='loopback', server=server)
+#
+import socket
+import logging
+import threading
+import typing as t
+
+import betterproto
+
+from protorpc.api import FrameDict, parse_fields
+from protorpc.connection.cobs import Deframer, FrameBuffer
+from protorpc.connection.codec import FrameCodec
+from protorpc.connection.tcp_connection import TcpConnection
+
+logger = logging.getLogger(__name__)
+
+# Reply header status values.
+STATUS_SUCCESS = 0
+STATUS_BAD_RESOLVER_LOOKUP = 1
+STATUS_BAD_HANDLER_LOOKUP = 2
+STATUS_HANDLER_ERROR = 3
+
+READ_SIZE = 65536
+
+
+class LoopbackServer:
+    """In-process RPC server dispatching calls to registered handlers.
+
+    A handler gets the call message and returns the reply message, a dict of
+    reply fields, or None (empty reply).  Unknown callsets (and header-only
+    pings) get BAD_RESOLVER_LOOKUP, calls without a handler
+    BAD_HANDLER_LOOKUP and handler exceptions HANDLER_ERROR, as on the device.
+    """
+
+    def __init__(self, frame_cls, handlers: t.Optional[t.Dict] = None):
+        self.frame_cls = frame_cls
+        self.handlers = {}
+        self.calls = 0
+        self.threads = []
+        parse_fields(frame_cls())
+        self.callsets = {name: FrameDict[name] for name in FrameDict}
+        for (callset, call), func in (handlers or {}).items():
+            self.register(callset, call, func)
+
+    def register(self, callset: str, call: str, func: t.Callable):
+        """Registers the handler for a call, e.g. ('test_callset', 'get_value').
+        """
+        if callset not in self.callsets:
+            raise ValueError(f"Unknown callset: {callset}.")
+        if f"{call}_reply" not in self.callsets[callset].msgs:
+            raise ValueError(f"Unknown call: {callset}.{call}.")
+        self.handlers[(callset, call)] = func
+
+    def handle(self, data: t.ByteString) -> t.Optional[bytes]:
+        """Handles a request frame, returning the reply frame (None for
+        no_reply requests).
+        """
+        request = self.frame_cls().parse(bytes(data))
+        self.calls += 1
+        reply = self.frame_cls()
+        reply.header.seqn = request.header.seqn
+
+        callset_name, callset = betterproto.which_one_of(request, 'callset')
+        if not callset_name:
+            reply.header.status = STATUS_BAD_RESOLVER_LOOKUP
+        else:
+            msg_name, msg = betterproto.which_one_of(callset, 'msg')
+            call = msg_name[:-len('_call')]
+            func = self.handlers.get((callset_name, call))
+            if func is None:
+                reply.header.status = STATUS_BAD_HANDLER_LOOKUP
+            else:
+                reply_cls = self.callsets[callset_name].msgs[f"{call}_reply"].cls
+                try:
+                    result = func(msg)
+                    if result is None:
+                        result = reply_cls()
+                    elif isinstance(result, dict):
+                        result = reply_cls(**result)
+                    reply.header.status = STATUS_SUCCESS
+                except Exception as e:
+                    logger.error(f"Loopback handler {callset_name}.{call}: {str(e)}")
+                    result = reply_cls()
+                    reply.header.status = STATUS_HANDLER_ERROR
+                reply_callset = type(callset)()
+                setattr(reply_callset, f"{call}_reply", result)
+                setattr(reply, callset_name, reply_callset)
+
+        if request.header.no_reply:
+            return None
+        return bytes(reply)
+
+    def serve(self, sock, codec=None):
+        """Serves a socket in a thread until it is closed.
+        """
+        thread = threading.Thread(target=self.serve_loop, args=(sock, codec), daemon=True,
+                                  name="loopback-server")
+        self.threads.append(thread)
+        thread.start()
+
+    def serve_loop(self, sock, codec):
+        deframer = Deframer()
+        framebuf = FrameBuffer()
+        rxbuf = bytearray(READ_SIZE)
+        with sock:
+            while True:
+                try:
+                    nbytes = sock.recv_into(rxbuf)
+                except OSError:
+                    break
+                if not nbytes:
+                    break
+
+                replies = []
+                for frame in deframer.process(memoryview(rxbuf)[:nbytes]):
+                    try:
+                        if codec is not None:
+                            frame, _ = codec.decode(frame)
+                        reply = self.handle(frame)
+                    except Exception as e:
+                        logger.error(f"Loopback server: dropping frame: {str(e)}")
+                        continue
+                    if reply is not None:
+                        replies.append(reply if codec is None else codec.encode(reply)[0])
+
+                if replies:
+                    try:
+                        sock.sendall(framebuf.frame(*replies))
+                    except OSError:
+                        break
+        logger.debug("Loopback server connection closed.")
+
+
+class LoopbackConnection(TcpConnection):
+    """TcpConnection to an in-process LoopbackServer over a socketpair.
+    """
+
+    requires_addr = False
+
+    def __init__(self, **kwargs):
+        self.server = kwargs.pop('server', None)
+        if self.server is None:
+            raise Exception("'server' (a LoopbackServer) must be provided.")
+        # Nothing to reconnect to.
+        kwargs['reconnect'] = False
+        super().__init__(**kwargs)
+        self.addr = 'loopback'
+
+    def open_socket(self):
+        """Replaces the socket with one end of a socketpair, the other end
+        served by the LoopbackServer.
+        """
+        self.socket.close()
+        self.socket, server_sock = socket.socketpair()
+        self.socket.settimeout(self.rcv_timeout)
+        codec = None
+        if self.codec is not None:
+            codec = FrameCodec(self.codec.level, self.codec.threshold)
+        self.server.serve(server_sock, codec)
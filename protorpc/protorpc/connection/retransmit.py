@@ -0,0 +1,125 @@
+# Selective retransmission for datagram connections.
+#
+# Each pending request has its own retransmit timer.  The retransmit timeout
+# (RTO) follows the smoothed RTT of replies as in RFC 6298, with Karn's rule
+# (retransmitted requests give no RTT sample) and exponential backoff.
+#
+import time
+import logging
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+RTO_INIT = 0.2
+RTO_MIN = 0.02
+RTO_MAX = 1.0
+MAX_RETRIES = 4
+
+
+class RttEstimator:
+    """Smoothed RTT and retransmit timeout estimator (RFC 6298).
+    """
+
+    def __init__(self, rto_init=RTO_INIT, rto_min=RTO_MIN, rto_max=RTO_MAX):
+        self.rto_min = rto_min
+        self.rto_max = rto_max
+        self.srtt = None
+        self.rttvar = None
+        self.rto = rto_init
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.rto_min), self.rto_max)
+
+
+class Retransmitter:
+    """Retransmits pending requests not replied to within the RTO, up to
+    max_retries times (then the request times out as usual).  Requests are
+    resent with their original seqn, so late duplicate replies find no
+    pending request and are dropped by dispatch.
+
+    Only idempotent requests and acknowledged no_reply requests are
+    retransmitted, as the device would execute a resent request again.  Other
+    requests are tracked for RTT samples only and time out if lost.
+    """
+
+    def __init__(self, conn, max_retries=MAX_RETRIES, clock=time.monotonic, **rto_kwargs):
+        self.conn = conn
+        self.max_retries = max_retries
+        self.clock = clock
+        self.rtt = RttEstimator(**rto_kwargs)
+        self.lock = Lock()
+        # seqn -> [request, t_sent, due (None if not retransmitted), attempts]
+        self.entries = {}
+        self.retransmits = 0
+
+    def can_retransmit(self, request):
+        """True if the request is safe to send again.
+        """
+        return request.idempotent or request.no_reply
+
+    def track(self, request):
+        now = self.clock()
+        due = now + self.rtt.rto if self.can_retransmit(request) else None
+        with self.lock:
+            self.entries[request.seqn] = [request, now, due, 1]
+
+    def untrack(self, seqn):
+        with self.lock:
+            return self.entries.pop(seqn, None)
+
+    def acked(self, seqn):
+        """Called with the reply to a tracked request.
+        """
+        entry = self.untrack(seqn)
+        if entry is not None and entry[3] == 1:
+            self.rtt.sample(self.clock() - entry[1])
+
+    def due_in(self):
+        """Seconds until the next retransmit is due (None if none tracked).
+        """
+        with self.lock:
+            due = min((entry[2] for entry in self.entries.values() if entry[2] is not None),
+                      default=None)
+        if due is None:
+            return None
+        return max(0.0, due - self.clock())
+
+    def service(self):
+        """Retransmits requests whose timer expired.
+        """
+        now = self.clock()
+        resend = []
+        with self.lock:
+            # Drop requests completed without a reply (timed out, cancelled).
+            for seqn in [seqn for seqn, entry in self.entries.items() if entry[0].done]:
+                del self.entries[seqn]
+
+            exhausted = []
+            for seqn, entry in self.entries.items():
+                request, _, due, attempts = entry
+                if due is None or due > now:
+                    continue
+                if attempts > self.max_retries:
+                    # Left to time out; no RTT sample after retransmits.
+                    exhausted.append(seqn)
+                    continue
+                entry[3] += 1
+                # Exponential backoff per request.
+                entry[2] = now + min(self.rtt.rto * 2 ** attempts, self.rtt.rto_max)
+                resend.append(request)
+            for seqn in exhausted:
+                del self.entries[seqn]
+
+        for request in resend:
+            logger.debug(f"Retransmitting seqn={request.seqn}.")
+            self.retransmits += 1
+            try:
+                self.conn.write(request.ser)
+            except Exception as e:
+                logger.error(f"Retransmit of seqn={request.seqn} failed: {str(e)}")
@@ -0,0 +1,92 @@
+# Socket tuning profiles.
+#
+import socket
+import logging
+import typing as t
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SocketProfile:
+    nodelay: bool = False
+    quickack: bool = False
+    sndbuf: t.Optional[int] = None
+    rcvbuf: t.Optional[int] = None
+
+
+@dataclass
+class Keepalive:
+    idle: int = 10
+    interval: int = 5
+    count: int = 3
+
+
+PROFILES = {
+    'default': SocketProfile(),
+    'low_latency': SocketProfile(nodelay=True, quickack=True, sndbuf=16384, rcvbuf=16384),
+    'bulk': SocketProfile(sndbuf=1024 * 1024, rcvbuf=1024 * 1024),
+}
+
+
+def get_profile(profile) -> SocketProfile:
+    """Gets a SocketProfile by name (or returns the given profile).
+    """
+    if isinstance(profile, SocketProfile):
+        return profile
+    if profile is None:
+        return PROFILES['default']
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown socket profile: {profile}. "
+                         f"Must be {list(PROFILES)}.")
+    return PROFILES[profile]
+
+
+def setsockopt(sock, level, opt_name, value):
+    """Sets a socket option if the platform supports it.
+    """
+    opt = getattr(socket, opt_name, None)
+    if opt is None:
+        logger.debug(f"Socket option {opt_name} not available.")
+        return
+    try:
+        sock.setsockopt(level, opt, value)
+    except OSError as e:
+        logger.warning(f"Error setting socket option {opt_name}={value}: {str(e)}")
+
+
+def apply_profile(sock, profile, keepalive=None):
+    """Applies a socket profile (and TCP keepalive settings) to a socket.
+    TCP only options are skipped for datagram sockets.
+    """
+    profile = get_profile(profile)
+    is_tcp = sock.type == socket.SOCK_STREAM
+
+    if profile.sndbuf is not None:
+        setsockopt(sock, socket.SOL_SOCKET, 'SO_SNDBUF', profile.sndbuf)
+    if profile.rcvbuf is not None:
+        setsockopt(sock, socket.SOL_SOCKET, 'SO_RCVBUF', profile.rcvbuf)
+
+    if not is_tcp:
+        return
+
+    if profile.nodelay:
+        setsockopt(sock, socket.IPPROTO_TCP, 'TCP_NODELAY', 1)
+    if profile.quickack:
+        setsockopt(sock, socket.IPPROTO_TCP, 'TCP_QUICKACK', 1)
+
+    if keepalive:
+        if not isinstance(keepalive, Keepalive):
+            keepalive = Keepalive()
+        setsockopt(sock, socket.SOL_SOCKET, 'SO_KEEPALIVE', 1)
+        setsockopt(sock, socket.IPPROTO_TCP, 'TCP_KEEPIDLE', keepalive.idle)
+        setsockopt(sock, socket.IPPROTO_TCP, 'TCP_KEEPINTVL', keepalive.interval)
+        setsockopt(sock, socket.IPPROTO_TCP, 'TCP_KEEPCNT', keepalive.count)
+
+
+def requickack(sock, profile):
+    """Re-arms TCP_QUICKACK, which Linux clears after use.
+    """
+    if get_profile(profile).quickack and sock.type == socket.SOCK_STREAM:
+        setsockopt(sock, socket.IPPROTO_TCP, 'TCP_QUICKACK', 1)
@@ -1,65 +1,282 @@
+import time
 import logging
 import socket
 import typing as t
+from collections import deque
+from threading import Lock
 
 import protorpc.connection.cobs as cobs
 from protorpc.connection import setdefault
 from protorpc.connection import BaseConnection
-from protorpc.connection.cobs import Deframer
+from protorpc.connection.cobs import Deframer, FrameBuffer
+from protorpc.connection.sockopts import apply_profile, requickack
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_PORT = 13001
+TXBUF_SIZE = 2048
+MAX_RCVBUF_SIZE = 65536
+IOV_MAX = 1024
+BACKOFF_MIN = 0.05
+BACKOFF_MAX = 5.0
 
 
 class TcpConnection(BaseConnection):
     """A connection class using TCP + COBS.
+
+    When the link is lost and reconnect is enabled (default), the connection
+    thread reconnects with exponential backoff (backoff_min to backoff_max
+    seconds).  Idempotent requests pending at link loss, or whose write
+    failed while reconnecting, are replayed once reconnected; others are
+    failed immediately.
     """
 
     def __init__(self, **kwargs):
 
         # Set the default port for TCP.
         setdefault(kwargs, 'port', DEFAULT_PORT)
+        max_frame_len = kwargs.pop('max_frame_len', cobs.DEFAULT_MAX_FRAME_LEN)
+        self.reconnect = kwargs.pop('reconnect', True)
+        self.backoff_min = kwargs.pop('backoff_min', BACKOFF_MIN)
+        self.backoff_max = kwargs.pop('backoff_max', BACKOFF_MAX)
         super().__init__('tcpconn', **kwargs)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.deframer = Deframer()
+        self.deframer = Deframer(max_frame_len, self.oversize_frame)
+        self.rx_frames = deque()
+        # Scratch buffer reused for framing writes (guarded by write_lock).
+        self.framebuf = FrameBuffer(TXBUF_SIZE)
+        self.write_lock = Lock()
         self.is_connected = False
+        # Link state: INIT, CONNECTED, RECONNECTING or CLOSED.
+        self.state = 'INIT'
+        self.link_lock = Lock()
+        # Requests to replay once reconnected, by seqn (guarded by link_lock).
+        self.replay = {}
+        self.reconnects = 0
+        self.downtime = 0.0
+        self.down_since = None
 
-    def connect(self, timeout=3, rcvbuf_size=1024):
+    def connect(self, timeout=3, rcvbuf_size=1024, max_rcvbuf_size=MAX_RCVBUF_SIZE):
         self.rcv_timeout = timeout
-        self.rcvbuf_size = rcvbuf_size
+        # Receive size adapts between rcvbuf_size and max_rcvbuf_size.
+        self.rcvbuf_size = min(rcvbuf_size, max_rcvbuf_size)
+        self.max_rcvbuf_size = max_rcvbuf_size
+        self.rxbuf = bytearray(max_rcvbuf_size)
+        self.rxview = memoryview(self.rxbuf)
         self.socket.settimeout(self.rcv_timeout)
+        apply_profile(self.socket, self.profile, self.keepalive)
         try:
-            self.socket.connect((self.addr, self.port))
+            self.open_socket()
             self.is_connected = True
+            self.state = 'CONNECTED'
             self.start()
             logger.debug(f"TcpConnection connected {self.addr}:{self.port}")
         except Exception as e:
             logger.error(f"Error connecting to {self.addr}:{self.port}")
             raise e
 
+    def open_socket(self):
+        """Connects the socket to the device.
+        """
+        self.socket.connect((self.addr, self.port))
+
+    @property
+    def is_reconnecting(self):
+        return self.state == 'RECONNECTING'
+
+    def link_down(self, reason):
+        """Marks the link as lost.  Non-idempotent pending requests are failed
+        and the connection thread is woken up to reconnect.
+        """
+        with self.link_lock:
+            if self.state != 'CONNECTED':
+                return
+            self.state = 'RECONNECTING' if self.reconnect else 'CLOSED'
+            self.is_connected = False
+            self.down_since = time.monotonic()
+
+        logger.warning(f"Link to {self.addr}:{self.port} lost: {reason}.")
+        try:
+            # Wakes up a recv blocked in another thread, which close() alone
+            # does not.
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+        for request in self.fail_pending(keep_idempotent=self.reconnect):
+            self.queue_replay(request)
+        self.wakeup.set()
+
+    def queue_replay(self, request):
+        with self.link_lock:
+            if self.state != 'RECONNECTING':
+                return False
+            self.replay[request.seqn] = request
+        return True
+
+    def check_link(self):
+        """Reconnects (with exponential backoff) when the link was lost, then
+        replays pending idempotent requests.
+        """
+        if self.state != 'RECONNECTING':
+            return
+
+        backoff = self.backoff_min
+        while not self.event.is_set():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(self.rcv_timeout)
+            apply_profile(sock, self.profile, self.keepalive)
+            try:
+                sock.connect((self.addr, self.port))
+                break
+            except OSError as e:
+                sock.close()
+                logger.debug(f"Reconnect to {self.addr}:{self.port} failed: {str(e)}; "
+                             f"retrying in {backoff:.2f}s.")
+                self.check_timeouts()
+                self.event.wait(backoff)
+                backoff = min(2 * backoff, self.backoff_max)
+        else:
+            return
+
+        with self.write_lock:
+            self.socket = sock
+            self.deframer = Deframer(self.deframer.max_frame_len, self.oversize_frame)
+            self.rx_frames.clear()
+
+        # Take the replay list with the state change, so requests written on
+        # the new link by other threads are not replayed.
+        with self.link_lock:
+            replay, self.replay = self.replay, {}
+            self.state = 'CONNECTED'
+            self.is_connected = True
+            self.reconnects += 1
+            down = time.monotonic() - self.down_since
+            self.downtime += down
+
+        # Frames still queued are sent by the writer.
+        queued = self.writer.queued_requests() if self.writer is not None else set()
+        replay = [r for r in replay.values()
+                  if r.idempotent and not r.done and r.ser is not None and r not in queued]
+
+        logger.info(f"Reconnected to {self.addr}:{self.port} after {down:.3f}s; "
+                    f"replaying {len(replay)} requests.")
+        for request in replay:
+            try:
+                self.write(request.ser)
+            except ConnectionError:
+                break
+
+    def locked_send(self, send_func):
+        """Runs a send function with write_lock held.  A socket error marks
+        the link as lost and raises ConnectionError.
+        """
+        try:
+            with self.write_lock:
+                send_func()
+        except socket.timeout:
+            raise
+        except OSError as e:
+            self.link_down(str(e))
+            raise ConnectionError(f"Tcp write: {str(e)}") from e
+
+    def check_connected(self):
+        """Returns True if connected.  Raises ConnectionError while
+        reconnecting.
+        """
+        if self.is_connected:
+            return True
+        if self.is_reconnecting:
+            raise ConnectionError("Tcp write: link lost, reconnecting.")
+        logger.warning("Tcp write: Not Connected. Call connect() before write().")
+        return False
+
     def encode(self, data: t.ByteString) -> t.ByteString:
         """Encodes data (used for testing).
         """
         return cobs.encode(data)
 
-    def write(self, data: t.ByteString, raw_write=False) -> None:
-        """Sends data.
+    def frame(self, *datas: t.ByteString) -> memoryview:
+        """COBS encodes and frames payloads back to back into the scratch
+        buffer.  Must be called with write_lock held.
         """
-        logger.debug(f"Writing data[{len(data)}]={self.bytes_to_hex(data, 64)} "
-                     f"to {self.addr}:{self.port}")
-        if self.is_connected:
-            if raw_write:
-                self.socket.send(data)
-            else:
-                # COBS encode and add framing.
-                encoded = self.encode(data)
-                framed = bytearray([0]) + encoded + bytearray([0])
+        return self.framebuf.frame(*datas)
+
+    def sendmsg_all(self, buffers: t.List[t.ByteString]) -> None:
+        """Sends a vector of buffers with as few sendmsg calls as possible,
+        resuming after partial writes.
+        """
+        if not hasattr(self.socket, 'sendmsg'):
+            self.socket.sendall(b''.join(buffers))
+            return
+
+        views = [memoryview(buf) for buf in buffers]
+        idx = 0
+        while idx < len(views):
+            sent = self.socket.sendmsg(views[idx:idx + IOV_MAX])
+            # Skip fully sent buffers and trim a partially sent one.
+            while idx < len(views) and sent >= len(views[idx]):
+                sent -= len(views[idx])
+                idx += 1
+            if sent:
+                views[idx] = views[idx][sent:]
+
+    def write(self, data: t.ByteString, raw_write=False):
+        """Sends data.  Returns the codec stats when compression is enabled.
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Writing data[{len(data)}]={self.bytes_to_hex(data, 64)} "
+                         f"to {self.addr}:{self.port}")
+        sample = None
+        if not self.check_connected():
+            return sample
+
+        if raw_write:
+            self.locked_send(lambda: self.socket.sendall(data))
+            return sample
+
+        if self.codec is not None:
+            data, sample = self.codec.encode(data)
+
+        def send_framed():
+            # COBS encode and add framing.
+            framed = self.frame(data)
+            if logger.isEnabledFor(logging.DEBUG):
                 logger.debug(f"Framed+encoded[{len(framed)}]: "
                              f"{self.bytes_to_hex(framed, 128)}")
-                self.socket.send(framed)
-        else:
-            logger.warning("Tcp write: Not Connected. Call connect() before write().")
+            self.socket.sendall(framed)
+
+        self.locked_send(send_framed)
+        return sample
+
+    def write_many(self, datas: t.List[t.ByteString], raw_write=False):
+        """Sends several payloads.  Framed payloads are encoded back to back
+        and sent with one sendall; raw buffers are sent as one sendmsg vector
+        without copying.  Returns the list of codec stats.
+        """
+        samples = [None] * len(datas)
+        if not self.check_connected():
+            return samples
+
+        if raw_write:
+            self.locked_send(lambda: self.sendmsg_all(datas))
+            return samples
+
+        if self.codec is not None and datas:
+            datas, samples = zip(*[self.codec.encode(data) for data in datas])
+            samples = list(samples)
+
+        def send_framed():
+            framed = self.frame(*datas)
+            logger.debug(f"Writing {len(datas)} frames[{len(framed)}] "
+                         f"to {self.addr}:{self.port}")
+            self.socket.sendall(framed)
+
+        self.locked_send(send_framed)
+        return samples
 
     def shutdown(self):
         self.socket.shutdown(socket.SHUT_RDWR)
@@ -67,28 +284,62 @@ class TcpConnection(BaseConnection):
     def close(self):
         """Closes the connection.
         """
+        with self.link_lock:
+            self.state = 'CLOSED'
         super().close()
         logger.debug("TcpConnection closing.")
         self.socket.close()
 
+    def adapt_rcvbuf_size(self, nbytes):
+        """Grows the receive size when a read fills it, or to fit the largest
+        frame seen, so large replies take few recv calls.
+        """
+        size = self.rcvbuf_size
+        if nbytes == size:
+            size *= 2
+        while size < self.deframer.largest_frame:
+            size *= 2
+        size = min(size, self.max_rcvbuf_size)
+        if size != self.rcvbuf_size:
+            logger.debug(f"Receive size {self.rcvbuf_size} -> {size}")
+            self.rcvbuf_size = size
+
     def read_loop(self):
-        """Reads the socket for data.
+        """Reads the socket until a frame is received.  Returns one frame per
+        call; further frames received in the same chunk are queued for the next
+        calls.
         """
+        if self.rx_frames:
+            return self.rx_frames.popleft()
+
         try:
-            data = self.socket.recv(self.rcvbuf_size)
-            if not data:
-                logger.debug("recv returned None")
-                return None
+            # Keep reading while a frame is only partially received.
+            while not self.rx_frames and not self.event.is_set():
+                nbytes = self.socket.recv_into(self.rxview, self.rcvbuf_size)
+                if not nbytes:
+                    logger.debug("recv returned None")
+                    self.link_down("closed by peer")
+                    return None
+
+                if self.profile.quickack:
+                    requickack(self.socket, self.profile)
 
-            msg = self.deframer.process(data)
-            if msg:
-                logger.debug(f"Received data[{len(data)}]={self.bytes_to_hex(data, 64)}")
-                return msg
+                # The deframer copies what it keeps, so the buffer is reused.
+                data = self.rxview[:nbytes]
+                self.rx_frames.extend(self.deframer.process(data))
+                self.adapt_rcvbuf_size(nbytes)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Received data[{nbytes}]={self.bytes_to_hex(data, 64)}")
+
+            if self.rx_frames:
+                return self.rx_frames.popleft()
+            return None
 
         except socket.timeout:
             logger.debug("recv timeout")
             return None
         except Exception as e:
-            logger.exception(f"Tcp read_loop: {str(e)}")
-            self.socket.close()
+            if self.state == 'CONNECTED':
+                logger.error(f"Tcp read_loop: {str(e)}")
+            self.link_down(str(e))
             return None
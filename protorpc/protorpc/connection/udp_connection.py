@@ -1,42 +1,228 @@
 import logging
 import socket
+import select
 import typing as t
+from collections import deque
+from threading import Lock
 
+import protorpc.connection.cobs as cobs
 from protorpc.connection import setdefault
 from protorpc.connection import BaseConnection
+from protorpc.connection.sockopts import apply_profile
+from protorpc.connection.retransmit import Retransmitter, MAX_RETRIES
+from protorpc.connection.fragment import FRAG_MAGIC, Reassembler, fragment
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_PORT = 13000
+DEFAULT_MTU = 1400
+# Largest UDP payload, so received datagrams are never truncated.
+MAX_DATAGRAM_SIZE = 65535
 
 
 class UdpConnection(BaseConnection):
     """A connection class using UDP.
+
+    A datagram normally carries one frame.  With pack=True (the device must
+    support it), every datagram sent is packed: it holds one or more COBS
+    framed frames (write_many fills datagrams up to mtu bytes, write sends a
+    pack of one).  Packed datagrams start with a zero delimiter, which a
+    plain protobuf frame never does, so received datagrams of either kind
+    are accepted.  Received datagrams are only unpacked when pack is
+    enabled, as a compressed frame sent raw (codec FLAG_RAW) also starts with
+    a zero byte; with both pack and compress, the device must pack its
+    replies, as is done here for requests.
+
+    With reliable=True, idempotent requests not replied to within the RTO
+    (derived from the measured RTT) are retransmitted with the same seqn, up
+    to max_retries times.  Duplicate replies are dropped.  Other requests are
+    never resent, as the device would execute them again, and time out if
+    lost.  With ack_no_reply=True, no_reply requests also ask for a reply, so
+    they are retransmitted until acknowledged (callers still do not wait).
+
+    With fragment=True, frames larger than mtu are sent as fragments
+    (see fragment).  Received fragments are always reassembled, within the
+    reassembly memory and time limits.
+
+    The socket is connected to the device, so the kernel filters datagrams
+    from other sources.  It is non-blocking: each read waits for the socket
+    to be readable, then drains every queued datagram.
     """
 
+    # Connect the socket to the device address (no for group addresses).
+    connect_socket = True
+
     def __init__(self, **kwargs):
         setdefault(kwargs, 'port', DEFAULT_PORT)
+        self.pack = kwargs.pop('pack', False)
+        self.mtu = kwargs.pop('mtu', DEFAULT_MTU)
+        reliable = kwargs.pop('reliable', False)
+        max_retries = kwargs.pop('max_retries', MAX_RETRIES)
+        self.ack_no_reply = kwargs.pop('ack_no_reply', False) and reliable
+        self.fragment = kwargs.pop('fragment', False)
+        self.reassembler = Reassembler(**kwargs.pop('reassembly', {}))
+        self.frag_seqn = 0
+        self.frag_seqn_lock = Lock()
         super().__init__('udpconn', **kwargs)
+        self.retx = Retransmitter(self, max_retries) if reliable else None
         self.is_connected = False
+        self.rx_frames = deque()
+        self.datagrams_sent = 0
+        self.frames_sent = 0
 
-    def connect(self, timeout=1, rcvbuf_size=1024):
+    def connect(self, timeout=1, rcvbuf_size=MAX_DATAGRAM_SIZE):
         self.rcv_timeout = timeout
         self.rcvbuf_size = rcvbuf_size
+        self.rxbuf = bytearray(rcvbuf_size)
+        self.rxview = memoryview(self.rxbuf)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.settimeout(self.rcv_timeout)
+        self.socket.setblocking(False)
+        apply_profile(self.socket, self.profile)
+        if self.connect_socket:
+            self.socket.connect((self.addr, self.port))
         self.is_connected = True
         self.start()
         logger.debug(f"UdpConnection connected {self.addr}:{self.port}")
 
-    def write(self, data: t.ByteString) -> None:
-        """Sends data.
+    def write(self, data: t.ByteString):
+        """Sends data.  Returns the codec stats when compression is enabled.
         """
-        logger.debug(f"Writing data[{len(data)}]={self.bytes_to_hex(data, 64)} "
-                     f"to {self.addr}:{self.port}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Writing data[{len(data)}]={self.bytes_to_hex(data, 64)} "
+                         f"to {self.addr}:{self.port}")
+        if self.pack:
+            # Packed too, so the device never sees a bare frame.
+            return self.write_many([data])[0]
+        sample = None
         if self.is_connected:
-            self.socket.sendto(data, (self.addr, self.port))
+            if self.codec is not None:
+                data, sample = self.codec.encode(data)
+            self.send_frame(data)
         else:
             logger.warning("Udp write: Not Connected.  Call connect() before write().")
+        return sample
+
+    def send_frame(self, data: t.ByteString):
+        """Sends an (encoded) frame in its own datagram, or as fragments if
+        fragmentation is enabled and it is larger than mtu.
+        """
+        if self.fragment and len(data) > self.mtu:
+            # Frames may be sent from several threads (caller, writer,
+            # retransmits); each needs its own fragment seqn.
+            with self.frag_seqn_lock:
+                self.frag_seqn += 1
+                seqn = self.frag_seqn
+            for datagram in fragment(seqn, data, self.mtu):
+                self.send_datagram(datagram)
+        else:
+            self.send_datagram(data)
+        self.frames_sent += 1
+
+    def send_datagram(self, data: t.ByteString):
+        """Sends a datagram, waiting (up to the receive timeout) for room in
+        the socket send buffer.
+        """
+        for _ in range(2):
+            try:
+                if self.connect_socket:
+                    self.socket.send(data)
+                else:
+                    self.socket.sendto(data, (self.addr, self.port))
+                self.datagrams_sent += 1
+                return
+            except BlockingIOError:
+                select.select([], [self.socket], [], self.rcv_timeout)
+        raise socket.timeout("Udp write: send buffer full.")
+
+    def pack_frames(self, datas: t.List[t.ByteString]) -> t.List[bytes]:
+        """Packs COBS framed payloads into as few datagrams of at most mtu
+        bytes as possible.  A payload larger than mtu gets its own datagram.
+        """
+        size = max(self.mtu, max(cobs.max_framed_len(len(data)) for data in datas))
+        view = memoryview(bytearray(size))
+        datagrams = []
+        length = 0
+        for data in datas:
+            if length and length + cobs.max_framed_len(len(data)) > self.mtu:
+                datagrams.append(bytes(view[:length]))
+                length = 0
+            length += cobs.encode_into(data, view[length:])
+        if length:
+            datagrams.append(bytes(view[:length]))
+        return datagrams
+
+    def write_many(self, datas: t.List[t.ByteString]):
+        """Sends several payloads, packed into shared datagrams when pack is
+        enabled.  Returns the list of codec stats.
+        """
+        if not self.pack or not datas:
+            return super().write_many(datas)
+
+        samples = [None] * len(datas)
+        if not self.is_connected:
+            logger.warning("Udp write: Not Connected.  Call connect() before write().")
+            return samples
+
+        if self.codec is not None and datas:
+            datas, samples = zip(*[self.codec.encode(data) for data in datas])
+            samples = list(samples)
+
+        if self.fragment:
+            # Frames too large to pack are fragmented.
+            for data in datas:
+                if cobs.max_framed_len(len(data)) > self.mtu:
+                    self.send_frame(data)
+            datas = [data for data in datas if cobs.max_framed_len(len(data)) <= self.mtu]
+            if not datas:
+                return samples
+
+        datagrams = self.pack_frames(datas)
+        logger.debug(f"Writing {len(datas)} frames in {len(datagrams)} datagrams "
+                     f"to {self.addr}:{self.port}")
+        for datagram in datagrams:
+            self.send_datagram(datagram)
+        self.frames_sent += len(datas)
+        return samples
+
+    def add_pending(self, request):
+        """Adds a request to the pending list, starting its retransmit timer.
+        """
+        super().add_pending(request)
+        if self.retx is not None and request.retransmit:
+            self.retx.track(request)
+
+    def reply_received(self, request):
+        if self.retx is not None:
+            self.retx.acked(request.seqn)
+
+    def check_timeouts(self):
+        """Times out expired requests and retransmits unanswered ones.
+        """
+        super().check_timeouts()
+        if self.retx is not None:
+            self.retx.service()
+        self.reassembler.expire()
+
+    def split_datagram(self, data: bytes) -> t.List[bytes]:
+        """Returns the frames of a received (non fragment) datagram.
+        """
+        if self.pack and data and data[0] == cobs.ESCAPED_BYTE:
+            return self.unpack_frames(data)
+        return [data]
+
+    def unpack_frames(self, data: t.ByteString) -> t.List[bytes]:
+        """Splits a packed datagram into decoded frames, skipping invalid
+        ones.
+        """
+        frames = []
+        for chunk in bytes(data).split(b'\x00'):
+            if not chunk:
+                continue
+            try:
+                frames.append(bytes(cobs.decode(chunk)))
+            except ValueError as e:
+                logger.error(f"Dropping invalid packed frame: {str(e)}")
+        return frames
 
     def close(self):
         """Closes the connection.
@@ -45,19 +231,53 @@ class UdpConnection(BaseConnection):
         logger.debug("UdpConnection closing.")
         self.socket.close()
 
+    def receive(self):
+        """Receives one datagram into the reused buffer and queues its
+        frames.  Raises BlockingIOError when no datagram is queued.
+        """
+        nbytes = self.socket.recv_into(self.rxview, self.rcvbuf_size)
+        if not nbytes:
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Received data[{nbytes}]={self.bytes_to_hex(self.rxview[:nbytes], 64)}")
+
+        if self.rxbuf[0] == FRAG_MAGIC:
+            # Copied straight into the reassembly buffer.
+            frame = self.reassembler.add(self.rxview[:nbytes])
+            if frame is not None:
+                self.rx_frames.append(frame)
+            return
+
+        self.rx_frames.extend(self.split_datagram(bytes(self.rxview[:nbytes])))
+
     def read_loop(self):
-        """Reads the socket for data.
+        """Reads the socket for data, waiting for the first datagram and then
+        draining any others already queued.  Frames are returned by
+        successive calls.
         """
-        try:
-            data, addr = self.socket.recvfrom(self.rcvbuf_size)
-            if not data:
-                return None
+        if self.rx_frames:
+            return self.rx_frames.popleft()
+
+        timeout = self.rcv_timeout
+        if self.retx is not None:
+            # Wake up in time for the next retransmit.
+            due_in = self.retx.due_in()
+            timeout = timeout if due_in is None else min(due_in, timeout)
 
-            logger.debug(f"Received data[{len(data)}]={self.bytes_to_hex(data, 64)}")
-            return data
+        try:
+            readable, _, _ = select.select([self.socket], [], [], timeout)
+            if readable:
+                while True:
+                    self.receive()
 
-        except socket.timeout:
-            return None
+        except BlockingIOError:
+            pass
+        except ConnectionRefusedError:
+            # ICMP port unreachable, reported on connected sockets.
+            logger.debug(f"Udp read_loop: {self.addr}:{self.port} unreachable.")
         except Exception as e:
             logger.error(f"Udp read_loop: {str(e)}")
-            return None
+
+        if self.rx_frames:
+            return self.rx_frames.popleft()
+        return None
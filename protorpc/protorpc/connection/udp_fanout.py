@@ -0,0 +1,204 @@
+import time
+import socket
+import logging
+import ipaddress
+from threading import Lock
+
+from protorpc.api import Reply, parse_header
+from protorpc.connection import setdefault
+from protorpc.connection.sockopts import setsockopt
+from protorpc.connection.udp_connection import UdpConnection, MAX_DATAGRAM_SIZE
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MCAST_TTL = 1
+
+
+class FanoutConnection(UdpConnection):
+    """UDP connection to a group of devices through a broadcast or multicast
+    address.
+
+    gather() sends one request frame to the group and collects the replies
+    (matched by seqn, one per source address) until the timeout elapses or
+    the expected number of replies is received.  Replies are returned as
+    {addr: Reply}.  Api calls are made with call.fanout(...).  There is no
+    connection thread; the socket is read by gather() only.
+    """
+
+    # Replies come from many addresses.
+    connect_socket = False
+
+    def __init__(self, **kwargs):
+        # Large receive buffer to absorb a burst of replies.
+        setdefault(kwargs, 'profile', 'bulk')
+        self.mcast_ttl = kwargs.pop('mcast_ttl', DEFAULT_MCAST_TTL)
+        # Requests are sent from the calling thread.
+        kwargs.pop('writer', None)
+        super().__init__(**kwargs)
+        self.gather_lock = Lock()
+        self.duplicate_replies = 0
+
+    def connect(self, timeout=1, rcvbuf_size=MAX_DATAGRAM_SIZE):
+        super().connect(timeout, rcvbuf_size)
+        setsockopt(self.socket, socket.SOL_SOCKET, 'SO_BROADCAST', 1)
+        if ipaddress.ip_address(self.addr).is_multicast:
+            setsockopt(self.socket, socket.IPPROTO_IP, 'IP_MULTICAST_TTL', self.mcast_ttl)
+
+    def start(self):
+        # Replies are read by gather(), no connection thread.
+        pass
+
+    def close(self):
+        """Closes the connection.
+        """
+        logger.debug("FanoutConnection closing.")
+        self.socket.close()
+
+    def add_pending(self, request):
+        # Replies are matched by gather(), not through the pending list.
+        self.frame_cls = type(request.frame)
+
+    def gather(self, request, timeout=1.0, expected=None):
+        """Sends a request to the group and collects the replies.
+        Returns {addr: Reply}.
+        """
+        with self.gather_lock:
+            ser = request.prepare(timeout)
+            if ser is None:
+                return {}
+
+            replies = {}
+            first = None
+            t_end = time.monotonic() + timeout
+            request.codec_stats = self.write(ser)
+
+            while expected is None or len(replies) < expected:
+                remaining = t_end - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.socket.settimeout(remaining)
+                try:
+                    nbytes, (addr, _) = self.socket.recvfrom_into(self.rxview, self.rcvbuf_size)
+                except socket.timeout:
+                    break
+                for frame in self.split_datagram(bytes(self.rxview[:nbytes])):
+                    frame, reply = self.make_reply(request, frame)
+                    if reply is None:
+                        continue
+                    if addr in replies:
+                        self.duplicate_replies += 1
+                        continue
+                    replies[addr] = reply
+                    first = frame if first is None else first
+
+            self.socket.setblocking(False)
+
+        logger.debug(f"Fan-out seqn={request.seqn}: {len(replies)} replies.")
+        if first is None:
+            request.set_timedout()
+        else:
+            request.handle_reply(first)
+        return replies
+
+    def make_reply(self, request, data):
+        """Decodes a received frame and parses it into a Reply for the request.
+        Returns (data, reply), the reply being None if the frame is not a
+        reply to the request.
+        """
+        try:
+            if self.codec is not None:
+                data, _ = self.codec.decode(data)
+            header = parse_header(self.frame_cls, data)
+            if header.seqn != request.seqn:
+                self.dropped_replies += 1
+                return data, None
+            reply = Reply(self.frame_cls, request.msg_name, request.msg_inst)
+            reply.rcv_handler(data)
+            return data, reply
+        except Exception as e:
+            logger.error(f"Error decoding fan-out reply, dropping frame: {str(e)}.")
+            return data, None
+
+
+if __name__ == "__main__":
+
+    # Demo over loopback, with compression enabled on both ends: a socket on
+    # 127.0.0.1 stands in for the group address, and each request is
+    # answered by devices on 127.0.0.2 and up.  Small replies are sent raw
+    # (codec FLAG_RAW), large ones compressed.
+    #
+    #   python -m protorpc.connection.udp_fanout
+    #
+    import threading
+    from dataclasses import dataclass
+
+    import betterproto
+    from rich.logging import RichHandler
+
+    from protorpc.api import make_api
+    from protorpc.connection.codec import FrameCodec
+    from protorpc.connection.loopback import LoopbackServer
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(RichHandler(show_time=False))
+
+    @dataclass(eq=False, repr=False)
+    class DemoHeader(betterproto.Message):
+        seqn: int = betterproto.uint32_field(1)
+        no_reply: bool = betterproto.bool_field(2)
+        status: int = betterproto.uint32_field(3)
+
+    @dataclass(eq=False, repr=False)
+    class GetValueCall(betterproto.Message):
+        size: int = betterproto.uint32_field(1)
+
+    @dataclass(eq=False, repr=False)
+    class GetValueReply(betterproto.Message):
+        value: int = betterproto.uint32_field(1)
+        blob: bytes = betterproto.bytes_field(2)
+
+    @dataclass(eq=False, repr=False)
+    class DemoCallset(betterproto.Message):
+        get_value_call: GetValueCall = betterproto.message_field(1, group="msg")
+        get_value_reply: GetValueReply = betterproto.message_field(2, group="msg")
+
+    @dataclass(eq=False, repr=False)
+    class DemoFrame(betterproto.Message):
+        header: DemoHeader = betterproto.message_field(1)
+        demo_callset: DemoCallset = betterproto.message_field(2, group="callset")
+
+    num_devices = 4
+    group = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    group.bind(('127.0.0.1', 0))
+    devices = []
+    for idx in range(num_devices):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((f"127.0.0.{idx + 2}", 0))
+        server = LoopbackServer(DemoFrame)
+        server.register('demo_callset', 'get_value',
+                        lambda call, idx=idx: {'value': idx, 'blob': bytes(call.size)})
+        devices.append((sock, server, FrameCodec()))
+
+    def relay():
+        while True:
+            data, addr = group.recvfrom(MAX_DATAGRAM_SIZE)
+            for sock, server, codec in devices:
+                reply = server.handle(codec.decode(data)[0])
+                sock.sendto(codec.encode(reply)[0], addr)
+
+    threading.Thread(target=relay, daemon=True).start()
+
+    conn = FanoutConnection(addr='127.0.0.1', port=group.getsockname()[1], compress=True)
+    conn.connect()
+    api = make_api(DemoFrame, conn)
+
+    for size in (4, 4096):
+        replies = api['demo_callset'].get_value.fanout(size=size, expected=num_devices)
+        values = sorted(reply.result.value for reply in replies.values())
+        if values == list(range(num_devices)) and all(
+                len(reply.result.blob) == size for reply in replies.values()):
+            logger.info(f"Pass: size={size} {len(replies)} replies from {sorted(replies)}")
+        else:
+            logger.error(f"Fail: size={size} {len(replies)}/{num_devices} replies")
+    conn.close()
@@ -0,0 +1,168 @@
+import logging
+from collections import deque
+from threading import Thread, Condition
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ['block', 'fail', 'drop_oldest']
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Writer(Thread):
+    """Connection writer thread fed by a bounded send queue.
+
+    submit() queues a serialized frame and returns without entering a socket
+    call.  The writer thread drains the queue, sending up to max_batch queued
+    frames with a single write_many.  When the queue is full, the policy
+    decides what happens:
+        block       : wait for room (up to put_timeout, then QueueFull)
+        fail        : raise QueueFull
+        drop_oldest : drop the oldest queued frame, failing its request
+    """
+
+    def __init__(self, conn, maxsize=256, policy='block', max_batch=64, put_timeout=None):
+        super().__init__()
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {policy}. Must be {POLICIES}.")
+        self.name = f"{conn.name}-writer"
+        self.daemon = True
+        self.conn = conn
+        self.maxsize = maxsize
+        self.policy = policy
+        self.max_batch = max_batch
+        self.put_timeout = put_timeout
+        self.queue = deque()
+        # Batch being written (guarded by cond).
+        self.inflight = []
+        self.cond = Condition()
+        self.stopping = False
+        # Stats.
+        self.max_depth = 0
+        self.written = 0
+        self.writes = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    @property
+    def depth(self):
+        """Number of frames waiting to be written.
+        """
+        return len(self.queue)
+
+    def queued_requests(self):
+        """Returns the set of requests with a frame queued or being written.
+        """
+        with self.cond:
+            return {request for _, request in (*self.queue, *self.inflight)
+                    if request is not None}
+
+    def make_room(self, count):
+        """Applies the backpressure policy until count entries fit.  Must be
+        called with cond held.  Returns the dropped entries.
+        """
+        dropped = []
+        if len(self.queue) + count <= self.maxsize:
+            return dropped
+
+        if self.policy == 'fail':
+            self.rejected += count
+            raise QueueFull(f"Send queue full ({self.maxsize} frames).")
+
+        if self.policy == 'drop_oldest':
+            while self.queue and len(self.queue) + count > self.maxsize:
+                dropped.append(self.queue.popleft())
+            self.dropped += len(dropped)
+            return dropped
+
+        if not self.cond.wait_for(lambda: len(self.queue) + count <= self.maxsize or self.stopping,
+                                  self.put_timeout):
+            self.rejected += count
+            raise QueueFull(f"Send queue full ({self.maxsize} frames), "
+                            f"timed out after {self.put_timeout}s.")
+        if self.stopping:
+            raise ConnectionError("Writer is stopped.")
+        return dropped
+
+    def submit(self, data, request=None):
+        """Queues a frame for writing.  The request (if given) gets its codec
+        stats once written, or is failed if the write fails.
+        """
+        self.submit_many([(data, request)])
+
+    def submit_many(self, entries):
+        """Queues several (data, request) entries.
+        """
+        # A batch larger than the queue only waits for the queue to empty.
+        count = min(len(entries), self.maxsize)
+        with self.cond:
+            if self.stopping:
+                raise ConnectionError("Writer is stopped.")
+            dropped = self.make_room(count)
+            self.queue.extend(entries)
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.cond.notify_all()
+
+        for _, request in dropped:
+            self.fail(request, "SEND QUEUE OVERFLOW")
+
+    def fail(self, request, reason):
+        if request is None:
+            return
+        self.conn.remove_pending(request.seqn)
+        request.set_failed(reason)
+
+    def stop(self):
+        """Stops the writer once the queue is drained.
+        """
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+
+    def close(self):
+        """Stops the writer and waits for the thread to exit.
+        """
+        self.stop()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+
+        logger.debug(f"Starting {self.name} loop.")
+
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.queue or self.stopping)
+                if not self.queue:
+                    break
+                batch = [self.queue.popleft()
+                         for _ in range(min(self.max_batch, len(self.queue)))]
+                self.inflight = batch
+                # Wake up producers blocked on a full queue.
+                self.cond.notify_all()
+
+            try:
+                samples = self.conn.write_many([data for data, _ in batch])
+                self.writes += 1
+                self.written += len(batch)
+                for (_, request), sample in zip(batch, samples):
+                    if request is not None:
+                        request.codec_stats = sample
+            except ConnectionError as e:
+                logger.error(f"{self.name} write error: {str(e)}")
+                for _, request in batch:
+                    # Idempotent requests stay pending for replay.
+                    if not (request is not None and request.idempotent and
+                            self.conn.queue_replay(request)):
+                        self.fail(request, "CONNECTION LOST")
+            except Exception as e:
+                logger.exception(f"{self.name} write error: {str(e)}")
+                for _, request in batch:
+                    self.fail(request, "CONNECTION LOST")
+
+            with self.cond:
+                self.inflight = []
+
+        logger.debug(f"{self.name} stopping.")
@@ -0,0 +1,179 @@
+import time
+import random
+import logging
+import typing as t
+from dataclasses import dataclass, field
+from threading import Thread, Event, Lock
+
+from protorpc.api import send_batch
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PollEntry:
+    call: t.Callable
+    period: float
+    args: tuple = ()
+    kwargs: t.Dict = field(default_factory=dict)
+    callback: t.Optional[t.Callable] = None
+    recorder: t.Any = None
+    timeout: float = 3
+    nominal: float = 0.0
+    next_due: float = 0.0
+    request: t.Any = None
+    issued: int = 0
+    skipped: int = 0
+    failed: int = 0
+
+
+class Poller(Thread):
+    """Periodic polling scheduler for Api calls.
+
+    Entries are polled with their own period.  Calls falling due within
+    `batch_window` of each other are issued together as one batch (a single
+    write per connection) without waiting on each reply, and each cycle is
+    offset by a random jitter of up to `jitter` * period to spread load.  An
+    entry whose previous request is still in flight skips its cycle.  Replies
+    are delivered to the entry callback and/or recorder from the poller
+    thread.
+    """
+
+    def __init__(self, batch_window=0.01, jitter=0.0, resolution=0.01,
+                 clock=time.monotonic):
+        super().__init__()
+        self.name = 'poller'
+        self.daemon = True
+        self.batch_window = batch_window
+        self.jitter = jitter
+        self.resolution = resolution
+        self.clock = clock
+        self.entries = []
+        self.lock = Lock()
+        self.event = Event()
+        self.batches = 0
+
+    def add(self, call, period, *args, callback=None, recorder=None, timeout=3,
+            **kwargs) -> PollEntry:
+        """Adds an Api call to be polled every `period` seconds.
+        """
+        entry = PollEntry(call=call,
+                          period=period,
+                          args=args,
+                          kwargs=kwargs,
+                          callback=callback,
+                          recorder=recorder,
+                          timeout=timeout)
+        entry.nominal = self.clock()
+        entry.next_due = entry.nominal + self._jitter(entry)
+        with self.lock:
+            self.entries.append(entry)
+        return entry
+
+    def remove(self, entry):
+        """Removes a polled entry.
+        """
+        with self.lock:
+            self.entries.remove(entry)
+
+    def stop(self):
+        """Stops the poller.
+        """
+        self.event.set()
+
+    def close(self):
+        """Stops the poller and waits for the thread to exit.
+        """
+        self.stop()
+        self.join()
+
+    def _jitter(self, entry):
+        return random.uniform(0, self.jitter * entry.period)
+
+    def _schedule(self, entry, now):
+        """Advances the entry to its next cycle, skipping missed cycles.
+        """
+        entry.nominal += entry.period
+        if entry.nominal < now:
+            entry.nominal = now
+        entry.next_due = entry.nominal + self._jitter(entry)
+
+    def _issue(self, due):
+        """Sends the requests of the due entries without waiting for replies.
+        Requests sharing a connection are sent with a single write.
+        """
+        batches = {}
+        for entry in due:
+            if entry.request is not None:
+                logger.debug(f"Poll {entry.call.__name__} still in flight, skipping.")
+                entry.skipped += 1
+                continue
+
+            try:
+                req = entry.call.request(*entry.args, **entry.kwargs)
+            except Exception as e:
+                logger.error(f"Poll {entry.call.__name__} request error: {str(e)}")
+                entry.failed += 1
+                continue
+            batches.setdefault((req.conn, entry.timeout), []).append((entry, req))
+
+        for (conn, timeout), batch in batches.items():
+            try:
+                send_batch([req for _, req in batch], timeout)
+            except Exception as e:
+                logger.error(f"Poll send error: {str(e)}")
+                for entry, _ in batch:
+                    entry.failed += 1
+                continue
+
+            for entry, req in batch:
+                entry.issued += 1
+                if not req.no_reply:
+                    entry.request = req
+                    # The reply may already be in.
+                    if req.done:
+                        self._deliver(entry)
+
+    def _deliver(self, entry):
+        """Delivers a completed request reply to the entry consumers.
+        """
+        req = entry.request
+        entry.request = None
+
+        if req.timedout or req.cancelled or req.failed:
+            entry.failed += 1
+
+        if entry.recorder is not None:
+            entry.recorder.append(req.reply)
+
+        if entry.callback is not None:
+            try:
+                entry.callback(req.reply)
+            except Exception as e:
+                logger.exception(f"Poll {entry.call.__name__} callback: {str(e)}")
+
+    def run(self):
+
+        logger.debug("Starting poller loop.")
+
+        while not self.event.is_set():
+
+            with self.lock:
+                entries = list(self.entries)
+
+            for entry in entries:
+                if entry.request is not None and entry.request.done:
+                    self._deliver(entry)
+
+            now = self.clock()
+            due = [e for e in entries if e.next_due <= now + self.batch_window]
+            if due:
+                self.batches += 1
+                self._issue(due)
+                for entry in due:
+                    self._schedule(entry, now)
+
+            next_due = min((e.next_due for e in entries), default=now + self.resolution)
+            self.event.wait(max(0, min(self.resolution, next_due - self.clock())))
+
+        logger.debug("Poller stopping.")
@@ -0,0 +1,245 @@
+import time
+import socket
+import logging
+import typing as t
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Condition, Event, Thread
+
+from protorpc.api import Api, make_api
+import protorpc.connection.udp_connection as udp_connection
+import protorpc.connection.tcp_connection as tcp_connection
+
+logger = logging.getLogger(__name__)
+
+PROTOCOLS = {'tcp': tcp_connection.TcpConnection, 'udp': udp_connection.UdpConnection}
+DEFAULT_PORTS = {'tcp': tcp_connection.DEFAULT_PORT, 'udp': udp_connection.DEFAULT_PORT}
+
+
+@dataclass
+class PooledLink:
+    key: tuple
+    conn: t.Any
+    api: t.Dict[str, Api]
+    last_used: float = 0.0
+    checkouts: int = 0
+
+    def __getitem__(self, callset):
+        return self.api[callset]
+
+    @property
+    def healthy(self):
+        return self.conn.is_alive() and (self.conn.is_connected or self.conn.is_reconnecting)
+
+
+class ConnectionPool:
+    """Pool of connections keyed by device (addr, port, protocol).
+
+    checkout() hands out a PooledLink (an idle one if available, otherwise a
+    new connection up to max_conns per device, otherwise blocks until one is
+    checked in).  Each link carries its own Api dict, so components sharing a
+    pool reuse device sessions without sharing a socket.  Links idle for more
+    than idle_timeout seconds are closed, keeping at least min_conns per
+    device; idle links are checked on checkout/checkin and every
+    evict_interval seconds (default idle_timeout / 2, 0 disables the timer).
+    Extra kwargs are passed to every connection (timeout, profile, compress,
+    ...).
+    """
+
+    def __init__(self, frame_cls, min_conns=0, max_conns=4, idle_timeout=60.0,
+                 evict_interval=None, clock=time.monotonic, **conn_kwargs):
+        if max_conns < 1 or min_conns > max_conns:
+            raise ValueError(f"Invalid pool size: min_conns={min_conns}, max_conns={max_conns}.")
+        self.frame_cls = frame_cls
+        self.min_conns = min_conns
+        self.max_conns = max_conns
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.conn_kwargs = conn_kwargs
+        self.cond = Condition()
+        self.idle = {}
+        self.num_open = {}
+        self.closed = False
+        self.stopped = Event()
+        self.evict_interval = idle_timeout / 2 if evict_interval is None else evict_interval
+        self.evictor = None
+        if self.evict_interval > 0:
+            self.evictor = Thread(target=self.evict_loop, name='pool-evict', daemon=True)
+            self.evictor.start()
+
+    def get_key(self, addr=None, hostname=None, port=None, protocol='tcp'):
+        """Gets the pool key for a device, resolving the hostname and default
+        port.
+        """
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"Unsupported protocol: {protocol}. Must be {list(PROTOCOLS)}.")
+        if addr is None:
+            if hostname is None:
+                raise ValueError("Either 'addr' or 'hostname' must be provided.")
+            addr = socket.gethostbyname(hostname)
+        if port is None:
+            port = DEFAULT_PORTS[protocol]
+        return (addr, port, protocol)
+
+    def open_link(self, key):
+        """Opens a new connection for a device.
+        """
+        addr, port, protocol = key
+        conn = PROTOCOLS[protocol](addr=addr, port=port, **self.conn_kwargs)
+        conn.connect()
+        logger.debug(f"Pool opened {protocol} link to {addr}:{port}.")
+        return PooledLink(key, conn, make_api(self.frame_cls, conn), self.clock())
+
+    def close_link(self, link):
+        """Closes a link's connection and its stream channels.
+        """
+        for api in link.api.values():
+            for channel in api.streams.values():
+                channel.stop()
+        try:
+            link.conn.close()
+        except Exception as e:
+            logger.warning(f"Error closing pooled link {link.key}: {str(e)}")
+
+    def checkout(self, addr=None, hostname=None, port=None, protocol='tcp',
+                 timeout=None) -> PooledLink:
+        """Checks out a link to a device.  Raises TimeoutError if none is
+        available within timeout seconds (None waits forever).
+        """
+        key = self.get_key(addr, hostname, port, protocol)
+        t_end = None if timeout is None else time.monotonic() + timeout
+        stale = []
+        self.evict_idle()
+
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise RuntimeError("Connection pool is closed.")
+
+                idle = self.idle.setdefault(key, [])
+                link = None
+                while idle:
+                    candidate = idle.pop()
+                    if candidate.healthy:
+                        link = candidate
+                        break
+                    stale.append(candidate)
+                    self.num_open[key] -= 1
+
+                if link is not None or self.num_open.get(key, 0) < self.max_conns:
+                    break
+
+                remaining = None if t_end is None else t_end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"No pooled link to {key} available "
+                                       f"(max_conns={self.max_conns}).")
+                self.cond.wait(remaining)
+
+            if link is None:
+                # Reserve the slot, connect outside the lock.
+                self.num_open[key] = self.num_open.get(key, 0) + 1
+
+        for candidate in stale:
+            logger.debug(f"Discarding broken pooled link to {key}.")
+            self.close_link(candidate)
+
+        if link is None:
+            try:
+                link = self.open_link(key)
+            except Exception:
+                with self.cond:
+                    self.num_open[key] -= 1
+                    self.cond.notify()
+                raise
+
+        link.checkouts += 1
+        return link
+
+    def checkin(self, link: PooledLink):
+        """Returns a link to the pool.  Broken links are closed.
+        """
+        link.last_used = self.clock()
+        with self.cond:
+            keep = link.healthy and not self.closed
+            if keep:
+                self.idle.setdefault(link.key, []).append(link)
+            else:
+                self.num_open[link.key] -= 1
+            self.cond.notify()
+
+        if not keep:
+            self.close_link(link)
+        self.evict_idle()
+
+    @contextmanager
+    def session(self, **kwargs):
+        """Checks out a link for the duration of a with block, yielding its
+        Api dict.
+        """
+        link = self.checkout(**kwargs)
+        try:
+            yield link.api
+        finally:
+            self.checkin(link)
+
+    def warm(self, **kwargs):
+        """Opens connections to a device up to min_conns.
+        """
+        # Never waits for a link.
+        kwargs.pop('timeout', None)
+        links = []
+        key = self.get_key(**kwargs)
+        while self.num_open.get(key, 0) < self.min_conns:
+            links.append(self.checkout(**kwargs, timeout=0))
+        for link in links:
+            self.checkin(link)
+
+    def evict_idle(self):
+        """Closes links idle for longer than idle_timeout, keeping at least
+        min_conns per device.
+        """
+        now = self.clock()
+        evicted = []
+        with self.cond:
+            for key, idle in self.idle.items():
+                # Oldest links are at the front of the idle list.
+                while (idle and self.num_open[key] > self.min_conns and
+                       now - idle[0].last_used > self.idle_timeout):
+                    evicted.append(idle.pop(0))
+                    self.num_open[key] -= 1
+
+        for link in evicted:
+            logger.debug(f"Evicting idle pooled link to {link.key}.")
+            self.close_link(link)
+
+    def evict_loop(self):
+        """Evicts idle links every evict_interval seconds until the pool is
+        closed.
+        """
+        while not self.stopped.wait(self.evict_interval):
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.exception(f"Pool eviction error: {str(e)}")
+
+    def stats(self):
+        """Returns {key: (open, idle)} for each device.
+        """
+        with self.cond:
+            return {key: (num, len(self.idle.get(key, [])))
+                    for key, num in self.num_open.items()}
+
+    def close(self):
+        """Closes all idle links.  Links checked out are closed on checkin.
+        """
+        self.stopped.set()
+        with self.cond:
+            self.closed = True
+            links = [link for idle in self.idle.values() for link in idle]
+            for key in self.idle:
+                self.num_open[key] -= len(self.idle[key])
+            self.idle = {}
+            self.cond.notify_all()
+
+        for link in links:
+            self.close_link(link)
@@ -0,0 +1,118 @@
+import time
+import logging
+import typing as t
+from array import array
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TYPECODE = 'd'
+DEFAULT_CAPACITY = 1024
+
+
+def get_field_value(msg: t.Any, path: str) -> t.Any:
+    """Gets a (possibly nested) field value from a message using a dotted path.
+    """
+    value = msg
+    for name in path.split('.'):
+        value = getattr(value, name)
+    return value
+
+
+class Recorder:
+    """Columnar recorder of scalar reply fields.
+
+    Each selected field of the reply message is stored in its own array column
+    alongside a timestamp column, so only a few bytes are kept per sample
+    instead of the complete Reply object.  Columns are preallocated and grow by
+    doubling when full.
+
+    fields : list of dotted field paths within the reply message, or a dict
+             mapping the field path to an array typecode (default 'd').
+    """
+
+    def __init__(self, fields, capacity=DEFAULT_CAPACITY, clock=time.time):
+
+        if not isinstance(fields, dict):
+            fields = {name: DEFAULT_TYPECODE for name in fields}
+
+        self.fields = fields
+        self.clock = clock
+        self.capacity = max(1, capacity)
+        self.length = 0
+        self.skipped = 0
+        self.timestamps = self._alloc(DEFAULT_TYPECODE, self.capacity)
+        self.columns = {name: self._alloc(typecode, self.capacity)
+                        for name, typecode in fields.items()}
+
+    @staticmethod
+    def _alloc(typecode, size):
+        """Allocates a zeroed array of the given typecode and size.
+        """
+        col = array(typecode)
+        col.frombytes(bytes(col.itemsize * size))
+        return col
+
+    def _grow(self):
+        """Doubles the capacity of all columns.
+        """
+        for col in [self.timestamps, *self.columns.values()]:
+            col.frombytes(bytes(col.itemsize * self.capacity))
+        self.capacity *= 2
+        logger.debug(f"Recorder grown to capacity={self.capacity}")
+
+    def __len__(self):
+        return self.length
+
+    def append(self, reply, timestamp=None):
+        """Appends the selected fields of a reply. Unsuccessful replies are
+        skipped.
+        """
+        if reply.timedout or not reply.success:
+            self.skipped += 1
+            return
+
+        self.record(reply.result, timestamp)
+
+    def record(self, msg, timestamp=None):
+        """Appends the selected fields of a reply message.
+        """
+        if self.length == self.capacity:
+            self._grow()
+
+        idx = self.length
+        self.timestamps[idx] = self.clock() if timestamp is None else timestamp
+        for name, col in self.columns.items():
+            col[idx] = get_field_value(msg, name)
+        self.length += 1
+
+    def clear(self):
+        """Discards all recorded samples (capacity is kept).
+        """
+        self.length = 0
+        self.skipped = 0
+
+    def column(self, name):
+        """Returns a copy of a recorded column as an array.
+        """
+        col = self.timestamps if name == 'timestamp' else self.columns[name]
+        return col[:self.length]
+
+    def to_numpy(self):
+        """Exports the recorded columns as a dict of numpy arrays.
+        """
+        import numpy as np
+
+        def export(col):
+            return np.frombuffer(col, dtype=col.typecode, count=self.length).copy()
+
+        data = {'timestamp': export(self.timestamps)}
+        data.update({name: export(col) for name, col in self.columns.items()})
+        return data
+
+    def to_pandas(self):
+        """Exports the recorded columns as a pandas DataFrame indexed by
+        timestamp.
+        """
+        import pandas as pd
+
+        return pd.DataFrame(self.to_numpy()).set_index('timestamp')
@@ -0,0 +1,77 @@
+import time
+import logging
+from threading import Thread, Condition
+
+logger = logging.getLogger(__name__)
+
+
+class StreamChannel(Thread):
+    """Latest-value-wins command channel for an Api call.
+
+    update() stores the call arguments in a single pending slot and returns
+    immediately.  The channel thread sends the pending value as a no_reply
+    request.  If the link is slow, values which are superseded before being
+    sent are dropped (and counted) so that only the most recent value is ever
+    queued.
+    """
+
+    def __init__(self, call, clock=time.monotonic):
+        super().__init__()
+        self.name = f"stream-{call.__name__}"
+        self.daemon = True
+        self.call = call
+        self.clock = clock
+        self.cond = Condition()
+        self.pending = None
+        self.stopping = False
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency = 0.0
+
+    def update(self, *args, **kwargs):
+        """Sets the latest value to be sent, superseding any unsent value.
+        """
+        with self.cond:
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = (args, kwargs, self.clock())
+            self.cond.notify()
+
+    def stop(self):
+        """Stops the channel once the pending value (if any) is sent.
+        """
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+
+    def close(self):
+        """Stops the channel and waits for the thread to exit.
+        """
+        self.stop()
+        self.join()
+
+    def run(self):
+
+        logger.debug(f"Starting {self.name} loop.")
+
+        while True:
+            with self.cond:
+                while self.pending is None and not self.stopping:
+                    self.cond.wait()
+                if self.pending is None:
+                    break
+                args, kwargs, t_update = self.pending
+                self.pending = None
+
+            try:
+                req = self.call.request(*args, no_reply=True, **kwargs)
+                req.send()
+                self.sent += 1
+                # Time from update() until the value was written.
+                self.latency = self.clock() - t_update
+            except Exception as e:
+                logger.error(f"{self.name} send error: {str(e)}")
+                self.errors += 1
+
+        logger.debug(f"{self.name} stopping.")
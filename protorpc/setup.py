@@ -9,6 +9,11 @@ required = [
     "rich",
 ]
 
+extras = {
+    "numpy": ["numpy"],
+    "serial": ["pyserial"],
+}
+
 setup(
     name=NAME,
     version=VERSION,
@@ -18,8 +23,10 @@ setup(
         'console_scripts': [
             'run_protorpc_gen=protorpc.generator.generator:entrypoint',
             'protoc-gen-protorpc=protorpc.generator.generator:generator_main',
+            'protorpc_cobs_bench=protorpc.connection.cobs_bench:entrypoint',
         ],
     },
     packages=find_packages(),
-    install_requires=required
+    install_requires=required,
+    extras_require=extras
 )